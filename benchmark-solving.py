@@ -2,77 +2,421 @@
 
 # benchmark a release version of Polonius on a number of directories containing
 # nll-facts.
-# benchmark-solving <my-crate> <my-other-crate>
+# benchmark-solving [-j <workers>] [--batch-size <n>] [--cost-model <json>]
+#                   [-o <solve.csv>] <my-crate> <my-other-crate>
 
+import argparse
 import csv
+import multiprocessing as mp
 import os
+import queue
 import sys
-import timeit
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
-from benchmark import inputs_or_workdir, run_command
+from benchmark import (USAGE_FIELDS, CommandTimedOut, close_checkpoint,
+                       commit_checkpoint, inputs_or_workdir, open_checkpoint,
+                       run_command, sample_spread, sampling_done)
+from cost_model import load_facts, load_model, predict
+from nll_facts import (extracted, facts_location, fn_digests, fn_paths,
+                       indexed_fn_paths)
 
 POLONIUS_OPTIONS = ["--skip-timing"]
 POLONIUS_PATH = "../polonius/target/release/polonius"
 POLONIUS_COMMAND = [POLONIUS_PATH, *POLONIUS_OPTIONS]
-NR_REPEATS = 2
-HARD_TIMEOUT = "10m"
-SOFT_TIMEOUT = "5m"
+# Batches are timed by Polonius itself, which reports the solve-time of each
+# fact directory it is given.
+POLONIUS_TIMING_COMMAND = [POLONIUS_PATH]
+# Each function is solved until its solve-time is stable or it has been
+# sampled for SAMPLE_BUDGET seconds, see benchmark.sampling_done().
+SAMPLE_BUDGET = 60
+# Per-run timeouts, in seconds. Polonius is sent SIGTERM after the soft
+# timeout and killed after the hard timeout.
+HARD_TIMEOUT = 10 * 60
+SOFT_TIMEOUT = 5 * 60
+# One worker per CPU we may run on, each pinned to a CPU of its own
+NR_WORKERS = len(os.sched_getaffinity(0))
+# How long a worker waits for a free CPU before running unpinned, in seconds.
+# Workers that replace dead ones find none, as the dead don't give theirs back.
+CPU_WAIT = 10
 
 ALGORITHMS = ["Naive", "Hybrid", "DatafrogOpt"]
 
+# A group of functions of a crate to benchmark in one go. skipped holds the
+# (function path, algorithm) pairs not to run because they are predicted to
+# time out.
+Job = namedtuple("Job", ["program", "fn_paths", "batched", "skipped"])
+# The runtime samples of a (function, algorithm) pair, and the resource usage
+# of its fastest run. Batched runs share a process, and have no usage.
+Measurement = namedtuple("Measurement", ["samples", "usage"])
+# A (function, algorithm) pair that ran out of time after elapsed seconds
+TimedOut = namedtuple("TimedOut", ["elapsed"])
+
+SOLVE_HEADER = [
+    "program",
+    "function",
+    *[f"min {a} runtime" for a in ALGORITHMS],
+    *[f"{a} samples" for a in ALGORITHMS],
+    *[f"{a} spread" for a in ALGORITHMS],
+    *[f"{a} status" for a in ALGORITHMS],
+    *[f"{a} {field}" for field in USAGE_FIELDS for a in ALGORITHMS],
+]
+
 
 def run_with_timeout(command):
     return run_command(
-        ["timeout", f"--kill-after={HARD_TIMEOUT}", SOFT_TIMEOUT, *command])
+        command,
+        timeout=SOFT_TIMEOUT,
+        kill_after=HARD_TIMEOUT - SOFT_TIMEOUT)
 
 
 def benchmark_crate_fn(p, algorithm):
     """
-    Perform benchmarks on a function's input data, located in p
+    Perform benchmarks on a function's input data, located in p, returning
+    a Measurement, a TimedOut if a run timed out, or None on failure.
     """
-    benchmark_timer = timeit.Timer(
-        lambda: run_with_timeout([*POLONIUS_COMMAND, "-a", algorithm, "--", str(p)]))
+    samples = []
+    usages = []
     try:
-        return min(benchmark_timer.repeat(NR_REPEATS, number=1))
+        while not sampling_done(samples, SAMPLE_BUDGET):
+            res = run_with_timeout(
+                [*POLONIUS_COMMAND, "-a", algorithm, "--", str(p)])
+            samples.append(res.elapsed)
+            usages.append(res.usage)
+    except CommandTimedOut as e:
+        return TimedOut(e.elapsed)
     except RuntimeError:
         return None
+    return Measurement(samples, usages[samples.index(min(samples))])
 
 
-def benchmark_crate_fns(facts_path):
-    return ([p.stem, *[benchmark_crate_fn(p, a) for a in ALGORITHMS]]
-            for p in facts_path.iterdir()
-            if p.is_dir() and not p.stem[0] == ".")
+def parse_polonius_timings(output):
+    """
+    Parse Polonius' "Directory: <dir>" and "Time: <seconds>s" output into a
+    dictionary of solve-times per fact directory.
+    """
+    timings = dict()
+    directory = None
+    for line in output.splitlines():
+        if line.startswith("Directory: "):
+            directory = line[len("Directory: "):]
+        elif line.startswith("Time: ") and directory is not None:
+            timings[directory] = float(line[len("Time: "):].rstrip("s"))
+    return timings
 
 
-def benchmark_crate_folder(p):
+def benchmark_fn_batch(fn_paths, algorithm):
+    """
+    Solve the functions in fn_paths in a single Polonius process per round,
+    re-running those whose solve-times have not settled yet, and return the
+    solve-time samples Polonius reports for each as a Measurement. If a
+    round fails or times out, the functions still being sampled are retried
+    on their own to isolate the one(s) causing it, which get None or a
+    TimedOut.
+    """
+    samples = {str(p): [] for p in fn_paths}
+    pending = list(fn_paths)
+    try:
+        while pending:
+            output = run_with_timeout([
+                *POLONIUS_TIMING_COMMAND, "-a", algorithm, "--",
+                *[str(p) for p in pending]
+            ]).stdout
+            timings = parse_polonius_timings(output)
+            for p in pending:
+                if str(p) not in timings:
+                    raise RuntimeError(f"Polonius reported no time for {p}")
+                samples[str(p)].append(timings[str(p)])
+            pending = [
+                p for p in pending
+                if not sampling_done(samples[str(p)], SAMPLE_BUDGET)
+            ]
+    except RuntimeError as e:
+        if len(fn_paths) == 1:
+            return [
+                TimedOut(e.elapsed)
+                if isinstance(e, CommandTimedOut) else None
+            ]
+        retried = {
+            str(p): benchmark_fn_batch([p], algorithm)[0]
+            for p in pending
+        }
+    else:
+        retried = dict()
+
+    return [
+        retried[str(p)]
+        if str(p) in retried else Measurement(samples[str(p)], None)
+        for p in fn_paths
+    ]
+
+
+def summarise_measurement(measurement, skipped=False):
+    """
+    The minimum, number and spread of a function's samples, its status and
+    its resource usage.
+    """
+    no_usage = [None] * len(USAGE_FIELDS)
+    if skipped:
+        return None, None, None, "predicted timeout", no_usage
+    if isinstance(measurement, TimedOut):
+        status = f"timeout ({measurement.elapsed:.0f}s)"
+        return None, None, None, status, no_usage
+    if not measurement:
+        return None, None, None, "failed", no_usage
+    samples = measurement.samples
+    return (min(samples), len(samples), sample_spread(samples), "ok",
+            measurement.usage or no_usage)
+
+
+def benchmark_fn_algorithms(job):
+    """
+    Benchmark every algorithm on a group of functions of a crate, returning a
+    row per function. They all run in the same worker, and thereby on the
+    same CPU, to keep the comparison fair. Archived functions are extracted
+    for as long as the job runs.
+    """
+    measurements = dict()
+    with extracted(job.fn_paths) as fn_dirs:
+        fn_dir_of = dict(zip(job.fn_paths, fn_dirs))
+        for algorithm in ALGORITHMS:
+            job_fn_paths = [
+                p for p in job.fn_paths
+                if (str(p), algorithm) not in job.skipped
+            ]
+            job_fn_dirs = [fn_dir_of[p] for p in job_fn_paths]
+            if job.batched and job_fn_dirs:
+                fn_measurements = benchmark_fn_batch(job_fn_dirs, algorithm)
+            else:
+                fn_measurements = [
+                    benchmark_crate_fn(p, algorithm) for p in job_fn_dirs
+                ]
+            for p, m in zip(job_fn_paths, fn_measurements):
+                measurements[(str(p), algorithm)] = m
+
+    rows = []
+    for p in job.fn_paths:
+        runtimes, sample_counts, spreads, statuses, usages = zip(*[
+            summarise_measurement(
+                measurements.get((str(p), a)),
+                skipped=(str(p), a) in job.skipped) for a in ALGORITHMS
+        ])
+        rows.append([
+            job.program, p.stem, *runtimes, *sample_counts, *spreads,
+            *statuses, *[field for fields in zip(*usages) for field in fields]
+        ])
+    return rows
+
+
+def crate_fn_jobs(p, batch_size=0, done=frozenset()):
+    """
+    Split a crate's functions, except the (program, function) pairs in done,
+    into jobs: one per function, or batches of batch_size functions that are
+    solved by a single Polonius process.
+    """
     assert isinstance(p, Path)
     assert p.is_dir(), f"{p} must be a directory!"
 
-    facts_path = p / "nll-facts"
-    if not facts_path.is_dir():
-        facts_path = p
     program_name = p.stem
+    if facts_location(p).exists():
+        all_fn_paths = indexed_fn_paths(p)
+    else:
+        # A directory without nll-facts is taken to be the facts directory
+        all_fn_paths = fn_paths(p)
 
-    for fn_name_and_runtimes in benchmark_crate_fns(facts_path):
-        yield [program_name, *fn_name_and_runtimes]
+    crate_fn_paths = [
+        fn_path for fn_path in all_fn_paths
+        if (program_name, fn_path.stem) not in done
+    ]
+    if not batch_size:
+        return [
+            Job(program_name, [fn_path], False, frozenset())
+            for fn_path in crate_fn_paths
+        ]
+    return [
+        Job(program_name, crate_fn_paths[i:i + batch_size], True, frozenset())
+        for i in range(0, len(crate_fn_paths), batch_size)
+    ]
 
 
-def benchmark_crates_to_csv(dirs, out_fp):
+def duplicate_fns(dirs, done=frozenset()):
+    """
+    Find the functions of the crates in dirs, except the (program, function)
+    pairs in done, with the same facts as one before them. Returns them by
+    the (program, function) of that first one.
+    """
+    with ThreadPool() as pool:
+        digests = pool.map(fn_digests, dirs)
+    first_seen = dict()
+    copies = defaultdict(list)
+    for crate_path, crate_digests in zip(dirs, digests):
+        for fn_name, digest in crate_digests.items():
+            key = (crate_path.stem, fn_name)
+            if key in done:
+                continue
+            original = first_seen.setdefault(digest, key)
+            if original != key:
+                copies[original].append(key)
+    return copies
+
+
+def schedule_jobs(jobs, model, facts, skip_predicted_timeouts=True):
+    """
+    Order jobs longest-first by their solve-time as predicted by the cost
+    model from their facts, so that the worker pool is packed well. The
+    (function, algorithm) pairs predicted to exceed SOFT_TIMEOUT are skipped,
+    or, if skip_predicted_timeouts is False, their jobs are scheduled last.
+    """
+    scheduled = []
+    for job in jobs:
+        cost = 0.0
+        predicted_timeouts = set()
+        for p in job.fn_paths:
+            facts_row = facts.get((job.program, p.stem))
+            if facts_row is None:
+                continue
+            for algorithm, seconds in predict(model, facts_row).items():
+                if algorithm not in ALGORITHMS:
+                    continue
+                if seconds > SOFT_TIMEOUT:
+                    predicted_timeouts.add((str(p), algorithm))
+                    if skip_predicted_timeouts:
+                        continue
+                cost += min(seconds, SOFT_TIMEOUT)
+
+        if skip_predicted_timeouts:
+            job = job._replace(skipped=frozenset(predicted_timeouts))
+            scheduled.append(((False, -cost), job))
+        else:
+            scheduled.append(((bool(predicted_timeouts), -cost), job))
+
+    return [job for _, job in sorted(scheduled, key=lambda s: s[0])]
+
+
+def pin_to_cpu(cpus):
+    """
+    Pool initializer: pin this worker, and thereby the Polonius processes it
+    starts, to the next free CPU, or leave it unpinned if there is none.
+    """
+    try:
+        cpu = cpus.get(timeout=CPU_WAIT)
+    except queue.Empty:
+        print(f"pin_to_cpu: no free CPU for worker {os.getpid()}, "
+              "running it unpinned", file=sys.stderr)
+        return
+    os.sched_setaffinity(0, {cpu})
+
+
+def benchmark_crates_to_csv(dirs,
+                            out_fp,
+                            nr_workers=NR_WORKERS,
+                            batch_size=0,
+                            schedule=None,
+                            checkpoint=None):
+    """
+    Benchmark the crates in dirs and write a row per function to out_fp. If
+    writing to a checkpoint, its header is already written, functions
+    already in its journal are skipped and each row is committed to it.
+    Functions with identical facts are benchmarked once, and share the row.
+    """
     writer = csv.writer(out_fp)
-    writer.writerow([
-        "program", "function",
-        *[f"min({NR_REPEATS}) {a} runtime" for a in ALGORITHMS]
-    ])
-    for crate_count, c in enumerate(dirs, start=1):
-        print(
-            f"processing crate #{crate_count}/{len(dirs)}: {c.stem}"\
-            .ljust(os.get_terminal_size(0).columns),
-            file=sys.stderr,
-            end="\r")
-        writer.writerows(benchmark_crate_folder(c))
+    if checkpoint is None:
+        writer.writerow(SOLVE_HEADER)
+    done = checkpoint.done if checkpoint else frozenset()
+    copies = duplicate_fns(dirs, done)
+    skip = done | {copy for fn_copies in copies.values() for copy in fn_copies}
+    jobs = [job for c in dirs for job in crate_fn_jobs(c, batch_size, skip)]
+    if schedule:
+        jobs = schedule(jobs)
+    nr_fns = sum(len(job.fn_paths) for job in jobs)
+    print(
+        f"benchmarking {nr_fns} functions, and copying the results of "
+        f"{len(skip) - len(done)} duplicates",
+        file=sys.stderr)
+
+    available_cpus = sorted(os.sched_getaffinity(0))
+    nr_workers = min(nr_workers, len(available_cpus))
+    cpus = mp.Queue()
+    for cpu in available_cpus[:nr_workers]:
+        cpus.put(cpu)
+
+    with mp.Pool(nr_workers, initializer=pin_to_cpu,
+                 initargs=(cpus, )) as pool:
+        fn_count = 0
+        for rows in pool.imap(benchmark_fn_algorithms, jobs):
+            fn_count += len(rows)
+            print(
+                f"processed function #{fn_count}/{nr_fns}: {rows[-1][0]}/{rows[-1][1]}"\
+                .ljust(os.get_terminal_size(0).columns),
+                file=sys.stderr,
+                end="\r")
+            for row in rows:
+                for program, function in [(row[0], row[1]),
+                                          *copies.get((row[0], row[1]), [])]:
+                    writer.writerow([program, function, *row[2:]])
+                    if checkpoint is not None:
+                        commit_checkpoint(checkpoint, program, function)
+            out_fp.flush()
 
 
 if __name__ == '__main__':
-    crate_fact_list = inputs_or_workdir()
-    benchmark_crates_to_csv(crate_fact_list, sys.stdout)
+    parser = argparse.ArgumentParser(
+        description="Benchmark Polonius on the nll-facts of crates.")
+    parser.add_argument(
+        "crates",
+        nargs="*",
+        help="crate directories to benchmark (default: everything in work/)")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=NR_WORKERS,
+        help=f"number of pinned worker processes (default: {NR_WORKERS})")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=0,
+        help="solve this many functions per Polonius process and use its "
+        "own solve-time measurements (default: one process per function)")
+    parser.add_argument(
+        "--cost-model",
+        help="schedule longest-first and skip predicted timeouts using a "
+        "model from cost_model.py")
+    parser.add_argument(
+        "--facts",
+        default="facts.csv",
+        help="fact statistics for the cost model (default: facts.csv)")
+    parser.add_argument(
+        "--run-predicted-timeouts",
+        action="store_true",
+        help="run functions predicted to time out last instead of skipping "
+        "them")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="write to this file instead of stdout, and resume from where "
+        "an interrupted run left it")
+    args = parser.parse_args()
+
+    schedule = None
+    if args.cost_model:
+        model = load_model(args.cost_model)
+        facts = load_facts(args.facts)
+        schedule = lambda jobs: schedule_jobs(
+            jobs, model, facts,
+            skip_predicted_timeouts=not args.run_predicted_timeouts)
+
+    crate_fact_list = inputs_or_workdir(args.crates)
+    checkpoint = None
+    if args.output:
+        checkpoint = open_checkpoint(args.output, SOLVE_HEADER)
+    benchmark_crates_to_csv(
+        crate_fact_list,
+        checkpoint.out_fp if checkpoint else sys.stdout,
+        nr_workers=args.jobs,
+        batch_size=args.batch_size,
+        schedule=schedule,
+        checkpoint=checkpoint)
+    if checkpoint:
+        close_checkpoint(checkpoint)
@@ -1,159 +1,765 @@
 #!/usr/bin/env python3
-import copy
+import argparse
 import csv
 import datetime
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing as mp
 import os
 import pathlib
+import re
+import resource
 import shutil
+import signal
+import statistics
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from contextlib import contextmanager
+from collections import defaultdict, deque, namedtuple
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
+from registry import (FAILED, ensure_imported, is_blacklisted, open_registry,
+                      record, record_status, repo_name_from)
+
 CLEAN_COMMAND = ["cargo", "+nightly", "clean"]
 CHECK_COMMAND = ["cargo", "+nightly", "check"]
+METADATA_COMMAND = [
+    "cargo", "+nightly", "metadata", "--no-deps", "--format-version=1"
+]
 ALGORITHMS = [
     "-Zpolonius -Zborrowck=mir",
     "-Zborrowck=mir",
 ]
-REPEAT_TIMES = 3
+# Experiments are repeated until the 95% confidence interval of their median
+# runtime is within SAMPLE_PRECISION of it, at least MIN_REPEATS and at most
+# MAX_REPEATS times, or until they have taken EXPERIMENT_BUDGET seconds.
+MIN_REPEATS = 2
+MAX_REPEATS = 10
+EXPERIMENT_BUDGET = 10 * 60
+SAMPLE_PRECISION = 0.05
+# Resource usage of a command and its children, see resource_usage()
+USAGE_FIELDS = [
+    "max RSS (KiB)",
+    "user time",
+    "system time",
+    "context switches",
+    "page faults",
+]
+RESULTS_HEADER = [
+    "Repo",
+    "Polonius Runtime",
+    "NLL Runtime",
+    "p",
+    "Polonius Samples",
+    "Polonius Spread",
+    "NLL Samples",
+    "NLL Spread",
+    *[f"Polonius {field}" for field in USAGE_FIELDS],
+    *[f"NLL {field}" for field in USAGE_FIELDS],
+    "Polonius Borrowck",
+    "NLL Borrowck",
+    "Borrowck p",
+    "Logs",
+]
+# With --pass-timings, the MIR borrowck time of each of a repository's crates
+# is also written here
+BORROWCK_RESULTS = "borrowck.csv"
+BORROWCK_HEADER = ["Repo", "Crate", "Polonius Borrowck", "NLL Borrowck"]
+# A line of rustc -Ztime-passes output, e.g.
+# "time:   0.012; rss:   41MB ->   42MB (   +1MB)\tMIR_borrow_checking"
+TIME_PASSES_RE = re.compile(r"^\s*time:\s*([0-9.]+)[^\t]*\t(.*)$")
 NR_BENCHES = 0
 EMA = None
 ALPHA = 0.5
 
 PREVIOUS_RESULTS = None
 SEEN_REPOS = set()
+# Git must fail rather than ask for credentials of a missing repository. It
+# is passed to each git command, as threads clone at once, see clone_repo().
+GIT_ENV = {"GIT_TERMINAL_PROMPT": "0"}
+# A lock per directory being cloned into, so that threads cloning the same
+# repository, or repositories of the same name, take turns
+CLONE_LOCKS = defaultdict(threading.Lock)
+CLONE_LOCKS_LOCK = threading.Lock()
 WRAPPER_PATH = os.path.abspath(pathlib.Path("./rust-shim.sh"))
-
-with open("blacklist.txt") as fp:
-    BLACKLIST = set([l.strip() for l in fp.readlines()])
-
-
-def inputs_or_workdir():
-    if len(sys.argv) == 1:
+# With --cached-deps, each repository is built into its own target directory
+# under here, see run_cached_experiment()
+TARGET_CACHE = Path("target-cache").absolute()
+# The output of the commands run on a repository is streamed to compressed
+# logs in a directory of its own under here, see log_dir_of()
+LOG_DIR = Path("logs").absolute()
+# How many of the last lines of a logged command's output are kept for its
+# CommandResult and error message
+TAIL_LINES = 100
+# How long a command that has timed out gets to exit after SIGTERM before it
+# is killed, in seconds, see run_command()
+KILL_AFTER = 30
+# The prlimit options of the resource limits run_command() can set
+PRLIMIT_OPTIONS = {
+    resource.RLIMIT_AS: "as",
+    resource.RLIMIT_CORE: "core",
+    resource.RLIMIT_CPU: "cpu",
+    resource.RLIMIT_DATA: "data",
+    resource.RLIMIT_FSIZE: "fsize",
+    resource.RLIMIT_NOFILE: "nofile",
+    resource.RLIMIT_NPROC: "nproc",
+    resource.RLIMIT_RSS: "rss",
+    resource.RLIMIT_STACK: "stack",
+}
+# The resource limits of each process of the builds that find out whether a
+# repository is any good, see find-repos.py and get-repos.py: no core dumps,
+# and little enough address space that one runaway rustc fails on its own
+# rather than running the machine out of memory
+BUILD_LIMITS = {
+    resource.RLIMIT_CORE: (0, 0),
+    resource.RLIMIT_AS: (16 * 2**30, 16 * 2**30),
+}
+
+# A CSV output file with a completion journal, see open_checkpoint()
+Checkpoint = namedtuple("Checkpoint", ["out_fp", "journal_fp", "done"])
+# The outcome of run_command(). elapsed is the wall-clock time in seconds and
+# usage the command's resource usage as returned by resource_usage().
+CommandResult = namedtuple(
+    "CommandResult", ["args", "returncode", "stdout", "stderr", "elapsed", "usage"])
+
+def inputs_or_workdir(paths=None):
+    if paths is None:
+        paths = sys.argv[1:]
+    if not paths:
         print("Using directory work", file=sys.stderr)
         crate_fact_list = [p for p in Path("./work").iterdir()]
     else:
-        crate_fact_list = [Path(p) for p in sys.argv[1:]]
+        crate_fact_list = [Path(p) for p in paths]
 
     return [p for p in crate_fact_list if p.is_dir()]
 
 
-@contextmanager
-def chdir(d):
-    #print(f"changing directory to {d}")
-    starting_dir = os.getcwd()
-    os.chdir(d)
-    try:
-        yield
-    finally:
-        os.chdir(starting_dir)
+def open_checkpoint(out_path, header):
+    """
+    Open the CSV file out_path for appending rows, resuming an interrupted
+    run if its completion journal (out_path.journal) exists. Anything written
+    after the last journal entry is cut off, and the keys recorded in the
+    journal are returned in done, to be skipped. Without a journal, out_path
+    is started over with header.
+    """
+    journal_path = Path(f"{out_path}.journal")
+    done = set()
+    committed_size = None
+    if journal_path.is_file() and Path(out_path).is_file():
+        out_size = os.stat(out_path).st_size
+        with open(journal_path) as journal_fp:
+            for line in journal_fp:
+                if not line.endswith("\n"):
+                    break  # cut off mid-write
+                size, *key = line.rstrip("\n").split("\t")
+                if int(size) > out_size:
+                    break  # unsynced entries that outlived their rows
+                committed_size = int(size)
+                done.add(tuple(key))
+
+    if committed_size is None:
+        out_fp = open(out_path, "w", newline="")
+        journal_fp = open(journal_path, "w")
+        checkpoint = Checkpoint(out_fp, journal_fp, done)
+        csv.writer(out_fp).writerow(header)
+        commit_checkpoint(checkpoint)
+        return checkpoint
+
+    os.truncate(out_path, committed_size)
+    print(
+        f"Resuming {out_path}: {len(done - {()})} entries already done",
+        file=sys.stderr)
+    return Checkpoint(
+        open(out_path, "a", newline=""), open(journal_path, "a"), done)
+
+
+def commit_checkpoint(checkpoint, *key, sync=True):
+    """
+    Record that everything written so far, up to and including key, is
+    complete. Without sync, the commit survives the process being killed,
+    but not the machine crashing, which makes frequent commits cheap.
+    """
+    checkpoint.out_fp.flush()
+    if sync:
+        os.fsync(checkpoint.out_fp.fileno())
+    size = os.fstat(checkpoint.out_fp.fileno()).st_size
+    checkpoint.journal_fp.write("\t".join([str(size), *key]) + "\n")
+    checkpoint.journal_fp.flush()
+    if sync:
+        os.fsync(checkpoint.journal_fp.fileno())
 
 
-@contextmanager
-def temp_env(**environment):
+def close_checkpoint(checkpoint):
     """
-    Temporarily set environment variables.
+    Close a completed output file and remove its journal, so that the next
+    run starts over.
     """
-    old_env = copy.deepcopy(os.environ)
+    checkpoint.out_fp.close()
+    checkpoint.journal_fp.close()
+    os.unlink(checkpoint.journal_fp.name)
 
-    try:
-        for key, val in environment.items():
-            os.environ[key] = str(val)
 
-        yield
-    finally:
-        os.environ = old_env
+def resource_usage(rusage):
+    """
+    Pick the USAGE_FIELDS out of a struct_rusage. Since it comes from wait4(),
+    it covers all the descendants the command waited for, and the max RSS is
+    that of the largest one.
+    """
+    return [
+        rusage.ru_maxrss,
+        rusage.ru_utime,
+        rusage.ru_stime,
+        rusage.ru_nvcsw + rusage.ru_nivcsw,
+        rusage.ru_majflt + rusage.ru_minflt,
+    ]
+
+
+def prlimit_command(limits):
+    """
+    A util-linux prlimit command that sets the resource limits of limits
+    ({resource.RLIMIT_*: (soft, hard)}) and then runs the command following
+    it. Unlike preexec_fn, it is safe with threads around.
+    """
+
+    def value(limit):
+        return "unlimited" if limit == resource.RLIM_INFINITY else str(limit)
+
+    return [
+        "prlimit", *[
+            f"--{PRLIMIT_OPTIONS[limit]}={value(soft)}:{value(hard)}"
+            for limit, (soft, hard) in limits.items()
+        ], "--"
+    ]
+
+
+def dir_size(path):
+    """
+    The total size in bytes of the files under path, or 0 if it's missing.
+    """
+    size = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def trim_target_dir(target_dir, size_limit):
+    """
+    Remove the reused cargo target directory target_dir if it has grown past
+    size_limit bytes, so that it starts over. Returns whether it was removed.
+    """
+    size = dir_size(target_dir)
+    if size <= size_limit:
+        return False
+    print(
+        f"trim_target_dir: {target_dir} is {size / 2**30:.1f} GiB, removing it",
+        file=sys.stderr)
+    shutil.rmtree(target_dir, ignore_errors=True)
+    return True
+
+
+def log_dir_of(directory):
+    return LOG_DIR / directory.name
 
 
-def run_command(command):
-    res = subprocess.run(
-        command,
+def run_log(directory, name):
+    return log_dir_of(directory) / f"{name}.log.gz"
+
+
+def read_output(stream, lines, log_fp, log_lock):
+    for line in stream:
+        lines.append(line)
+        if log_fp is not None:
+            with log_lock:
+                log_fp.write(line)
+
+
+class CommandTimedOut(RuntimeError):
+    """
+    Raised by run_command() when a command overran its timeout, after it
+    has been killed. elapsed is how long it ran for, in seconds.
+    """
+
+    def __init__(self, message, elapsed):
+        super().__init__(message)
+        self.elapsed = elapsed
+
+    def __reduce__(self):
+        return CommandTimedOut, (self.args[0], self.elapsed)
+
+
+def run_command(command,
+                cwd=None,
+                env=None,
+                timeout=None,
+                kill_after=KILL_AFTER,
+                limits=None,
+                log=None):
+    """
+    Run command to completion and return its CommandResult, raising a
+    RuntimeError if it fails. The command runs in the directory cwd, with the
+    variables of env added to the environment and the resource limits of
+    limits ({resource.RLIMIT_*: (soft, hard)}) set by prlimit_command().
+    Nothing about the calling process is changed, so commands can be run
+    from any number of threads at once.
+
+    The command runs in a process group of its own, so that all of its
+    descendants can be signalled. After timeout seconds they are all sent
+    SIGTERM, and SIGKILL kill_after seconds later, and CommandTimedOut is
+    raised.
+
+    With a log path, the command and its output are appended to that gzip
+    file as they come, and only the last TAIL_LINES lines of its stdout and
+    stderr are kept in memory.
+    """
+    start_time = time.perf_counter()
+    limit_command = [] if limits is None else prlimit_command(limits)
+    proc = subprocess.Popen(
+        [*limit_command, *command],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         universal_newlines=True,
-        check=False)
+        # Build scripts and tests may print anything, and a reader thread
+        # that died on it would leave the command blocked on a full pipe
+        errors="replace",
+        cwd=cwd,
+        env=None if env is None else {
+            **os.environ,
+            **{key: str(val)
+               for key, val in env.items()}
+        },
+        process_group=0)
+
+    # The group must not be signalled once the command is reaped, as its ID
+    # may then be reused.
+    reaped = False
+    reap_lock = threading.Lock()
+    timed_out = threading.Event()
+
+    def signal_group(signum):
+        with reap_lock:
+            if reaped:
+                return
+            try:
+                os.killpg(proc.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def soft_deadline():
+        timed_out.set()
+        signal_group(signal.SIGTERM)
+
+    timers = []
+    if timeout is not None:
+        timers = [
+            threading.Timer(timeout, soft_deadline),
+            threading.Timer(timeout + kill_after, signal_group,
+                            (signal.SIGKILL, )),
+        ]
+        for timer in timers:
+            timer.start()
+
+    stdout = [] if log is None else deque(maxlen=TAIL_LINES)
+    stderr = [] if log is None else deque(maxlen=TAIL_LINES)
+    log_fp = None
+    try:
+        if log is not None:
+            log.parent.mkdir(parents=True, exist_ok=True)
+            # Appending adds a gzip member, which zcat reads as one file
+            log_fp = gzip.open(log, "at", errors="replace")
+            log_fp.write(f"$ {' '.join(command)}\n")
+        # Read both pipes so the command can't block on a full one, and reap
+        # it ourselves with wait4() to get its resource usage.
+        log_lock = threading.Lock()
+        stderr_reader = threading.Thread(
+            target=read_output, args=(proc.stderr, stderr, log_fp, log_lock))
+        stderr_reader.start()
+        read_output(proc.stdout, stdout, log_fp, log_lock)
+        stderr_reader.join()
+        _pid, status, rusage = os.wait4(proc.pid, 0)
+    except BaseException:
+        # Don't leave the group running when interrupted, as it doesn't get
+        # the terminal's signals
+        signal_group(signal.SIGKILL)
+        proc.wait()
+        raise
+    finally:
+        with reap_lock:
+            reaped = True
+        for timer in timers:
+            timer.cancel()
+        if log_fp is not None:
+            log_fp.close()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()
+    proc.stderr.close()
+
+    res = CommandResult(command, proc.returncode, "".join(stdout),
+                        "".join(stderr),
+                        time.perf_counter() - start_time,
+                        resource_usage(rusage))
+    log_part = "" if log is None else f" (full output in {log})"
+    if timed_out.is_set():
+        raise CommandTimedOut(
+            f"{' '.join(command)} timed out after {res.elapsed:.0f}s{log_part}. stderr={res.stderr}",
+            res.elapsed)
     if res.returncode != 0:
         raise RuntimeError(
-            f"error running {' '.join(command)}. stderr={res.stderr}")
+            f"error running {' '.join(command)}{log_part}. stderr={res.stderr}")
     return res
 
 
-def clean_dir(project=None):
+def sampling_done(samples,
+                  time_budget,
+                  min_samples=1,
+                  max_samples=MAX_REPEATS,
+                  spent=None):
+    """
+    Decide if a benchmark has been sampled enough: when the 95% confidence
+    interval of the median of samples is within SAMPLE_PRECISION of it, when
+    spent, the seconds taken so far (the sum of samples by default), has used
+    up time_budget, or at max_samples.
+    """
+    if spent is None:
+        spent = sum(samples)
+    if len(samples) < min_samples:
+        return False
+    if len(samples) >= max_samples or spent >= time_budget:
+        return True
+    if len(samples) < 2:
+        return False
+
+    import scipy.stats
+
+    # The standard error of the median, assuming normally distributed noise,
+    # and Student's t rather than the normal quantile, as there are few
+    # samples
+    median_error = 1.2533 * statistics.stdev(samples) / math.sqrt(
+        len(samples))
+    quantile = scipy.stats.t.ppf(0.975, len(samples) - 1)
+    return quantile * median_error <= SAMPLE_PRECISION * statistics.median(
+        samples)
+
+
+def sample_spread(samples):
+    return max(samples) - min(samples)
+
+
+def clean_dir(directory, project=None, target_dir=None):
     project_part = ["-p", project] if project else []
+    if target_dir is None:
+        target_dir = directory / "target"
 
-    #res = run_command([*CLEAN_COMMAND, *project_part])
+    #res = run_command([*CLEAN_COMMAND, *project_part], cwd=directory)
     shutil.rmtree(
-        pathlib.Path("target/debug") / pathlib.Path("build"),
+        target_dir / pathlib.Path("debug") / pathlib.Path("build"),
         ignore_errors=True)
     shutil.rmtree(
-        pathlib.Path("target/debug") / pathlib.Path("incremental"),
+        target_dir / pathlib.Path("debug") / pathlib.Path("incremental"),
         ignore_errors=True)
 
 
-def run_experiment(option_set, directory):
+def read_borrowck_times(timings_dir):
+    """
+    Sum up the MIR borrowck time in the -Ztime-passes output rust-shim.sh
+    wrote to timings_dir, per crate.
+    """
+    times = defaultdict(float)
+    for path in timings_dir.iterdir():
+        crate = path.name.rsplit(".", 1)[0]
+        with open(path, errors="replace") as fp:
+            for line in fp:
+                m = TIME_PASSES_RE.match(line)
+                # Spelled "MIR borrow checking" on older nightlies
+                if m and m.group(2).strip().replace(
+                        "_", " ").lower() == "mir borrow checking":
+                    times[crate] += float(m.group(1))
+    return dict(times)
+
+
+def timed_check(directory, env, pass_timings=False, log=None, limits=None):
+    """
+    Run cargo check in directory with the variables of env and the resource
+    limits of limits, logging its output to log. Returns its result and, if
+    pass_timings is set, the MIR borrowck time of each of the workspace's
+    crates.
+    """
+    if not pass_timings:
+        return run_command(
+            CHECK_COMMAND, cwd=directory, env=env, limits=limits,
+            log=log), None
+    with tempfile.TemporaryDirectory() as timings_dir:
+        res = run_command(
+            CHECK_COMMAND,
+            cwd=directory,
+            env={
+                **env, "PASS_TIMINGS_DIR": timings_dir
+            },
+            limits=limits,
+            log=log)
+        return res, read_borrowck_times(Path(timings_dir))
+
+
+def run_experiment(option_set,
+                   directory,
+                   pass_timings=False,
+                   log=None,
+                   target_dir=None,
+                   limits=None):
+    """
+    Time a cargo check of directory with option_set, returning the runtime,
+    resource usage and, with pass_timings, the borrowck time per crate. Its
+    output is appended to log if given, and printed otherwise. It builds into
+    target_dir if given, and directory/target otherwise, under the resource
+    limits of limits if given (see run_command()).
+    """
     print(f"running experiment {option_set} on {directory}")
-    with chdir(directory):
-        clean_dir(project=directory.stem)
-        start_time = time.time()
-        with temp_env(RUSTFLAGS=option_set), temp_env(
-                RUSTC_WRAPPER=WRAPPER_PATH):
-            _res = run_command(CHECK_COMMAND)
-            print(_res.stdout)
-            print(_res.stderr)
+    clean_dir(directory, project=directory.stem, target_dir=target_dir)
+    env = {"RUSTFLAGS": option_set, "RUSTC_WRAPPER": WRAPPER_PATH}
+    if target_dir is not None:
+        env["CARGO_TARGET_DIR"] = target_dir
+    _res, borrowck = timed_check(directory, env, pass_timings, log, limits)
+    if log is None:
+        print(_res.stdout)
+        print(_res.stderr)
+
+    return _res.elapsed, _res.usage, borrowck
 
-    return time.time() - start_time
 
+def target_dir_of(directory):
+    return TARGET_CACHE / directory.name
 
-def run_experiments(directory):
+
+def workspace_packages(directory):
+    """
+    The names of the packages in the Cargo workspace of directory.
+    """
+    res = run_command(METADATA_COMMAND, cwd=directory)
+    return [package["name"] for package in json.loads(res.stdout)["packages"]]
+
+
+def build_dependencies(directory, log=None):
+    """
+    Check directory once into its cached target directory, building its
+    dependencies and their build scripts for the following
+    run_cached_experiment() calls.
+    """
+    print(f"building dependencies of {directory}")
+    run_command(
+        CHECK_COMMAND,
+        cwd=directory,
+        env={
+            "CARGO_TARGET_DIR": target_dir_of(directory),
+            "RUSTC_WRAPPER": WRAPPER_PATH,
+            "BORROWCK_FLAGS": "",
+        },
+        log=log)
+
+
+def run_cached_experiment(option_set,
+                          directory,
+                          packages,
+                          pass_timings=False,
+                          log=None):
+    """
+    Like run_experiment(), but only the workspace's packages are cleaned and
+    rebuilt with option_set; dependencies are reused from
+    build_dependencies().
+    """
+    print(f"running cached experiment {option_set} on {directory}")
+    clean_packages = [arg for package in packages for arg in ["-p", package]]
+    env = {
+        "CARGO_TARGET_DIR": target_dir_of(directory),
+        "RUSTC_WRAPPER": WRAPPER_PATH,
+        "BORROWCK_FLAGS": option_set,
+    }
+    run_command([*CLEAN_COMMAND, *clean_packages],
+                cwd=directory,
+                env=env,
+                log=log)
+    _res, borrowck = timed_check(directory, env, pass_timings, log)
+
+    return _res.elapsed, _res.usage, borrowck
+
+
+def run_experiments(directory, cached_deps=False, pass_timings=False):
+    """
+    Benchmark directory under each of ALGORITHMS. Returns its results row
+    (without the repository) and, with pass_timings, the lowest borrowck
+    time of each algorithm per crate. The output of each algorithm's runs
+    goes to its log in log_dir_of(directory).
+    """
     import scipy.stats
 
-    def go(option_set):
+    if cached_deps:
+        build_dependencies(directory, run_log(directory, "dependencies"))
+        packages = workspace_packages(directory)
+
+    def experiment(option_set, log):
+        if cached_deps:
+            return run_cached_experiment(option_set, directory, packages,
+                                         pass_timings, log)
+        return run_experiment(option_set, directory, pass_timings, log)
+
+    def go(option_set, name):
         #print(f"running with {option_set} on {directory}")
-        #print("warming up...")
-        run_experiment(option_set, directory)
-        #print("warmed up!")
-        return [
-            run_experiment(option_set, directory) for _ in range(REPEAT_TIMES)
+        log = run_log(directory, name)
+        if not cached_deps:
+            # build_dependencies() already did this
+            #print("warming up...")
+            run_experiment(option_set, directory, log=log)
+            #print("warmed up!")
+        samples = []
+        usages = []
+        borrowck_samples = []
+        crate_samples = defaultdict(list)
+        # The borrowck time is much less noisy, so sample until it is precise
+        # enough when we have it. The budget is for the whole cargo check
+        # runs, though.
+        while not sampling_done(
+                borrowck_samples or samples,
+                EXPERIMENT_BUDGET,
+                min_samples=MIN_REPEATS,
+                spent=sum(samples)):
+            runtime, usage, borrowck = experiment(option_set, log)
+            samples.append(runtime)
+            usages.append(usage)
+            if pass_timings and not borrowck:
+                print(f"no borrowck timings for {option_set} on {directory}")
+            elif pass_timings:
+                borrowck_samples.append(sum(borrowck.values()))
+                for crate, seconds in borrowck.items():
+                    crate_samples[crate].append(seconds)
+        return samples, usages[samples.index(
+            min(samples))], borrowck_samples, crate_samples
+
+    (polonius_stats, polonius_usage, polonius_borrowck,
+     polonius_crates), (nll_stats, nll_usage, nll_borrowck, nll_crates) = [
+         go(setting, name)
+         for setting, name in zip(ALGORITHMS, ["polonius", "nll"])
+     ]
+    _t, p = scipy.stats.ttest_ind(polonius_stats, nll_stats)
+
+    # Without timings for both algorithms, there is nothing to compare
+    if polonius_borrowck and nll_borrowck:
+        _t, borrowck_p = scipy.stats.ttest_ind(polonius_borrowck, nll_borrowck)
+        borrowck_columns = [
+            min(polonius_borrowck),
+            min(nll_borrowck),
+            borrowck_p,
         ]
+    else:
+        borrowck_columns = ["", "", ""]
+    crate_times = {
+        crate: (min(polonius_crates[crate], default=""),
+                min(nll_crates[crate], default=""))
+        for crate in sorted(polonius_crates.keys() | nll_crates.keys())
+    }
 
-    polonius_stats, nll_stats = [go(setting) for setting in ALGORITHMS]
-    _t, p = scipy.stats.ttest_ind(polonius_stats, nll_stats)
+    return [
+        min(polonius_stats),
+        min(nll_stats),
+        p,
+        len(polonius_stats),
+        sample_spread(polonius_stats),
+        len(nll_stats),
+        sample_spread(nll_stats),
+        *polonius_usage,
+        *nll_usage,
+        *borrowck_columns,
+    ], crate_times
 
-    return [min(polonius_stats), min(nll_stats), p]
 
+def clone_lock(path):
+    with CLONE_LOCKS_LOCK:
+        return CLONE_LOCKS[Path(path).absolute()]
 
-def repo_name_from(url):
-    return url.split("/")[-1].split(".git")[0]
 
+def repo_dir_name(url):
+    """
+    A directory name for url that no other url shares, unlike its repository
+    name.
+    """
+    url_hash = hashlib.sha1(url.encode()).hexdigest()[:8]
+    return f"{repo_name_from(url)}-{url_hash}"
 
-def clone_repo(url, keep_files=False):
-    workdir = pathlib.Path("work")
-    repo_name = repo_name_from(url)
-    with chdir(workdir):
-        if not keep_files:
-            try:
-                shutil.rmtree(repo_name)
-            except FileNotFoundError:
-                pass
-        if not (pathlib.Path("./") / repo_name).exists():
-            with temp_env(GIT_TERMINAL_PROMPT="0"):
-                run_command([
-                    "git",
-                    "clone",
-                    #"--recurse-submodules",
-                    "--quiet",
-                    url
-                ])
-    return workdir / repo_name
 
+def update_mirror(url, mirror_cache):
+    """
+    Make or update a bare mirror of url's branches and tags in the directory
+    mirror_cache, returning its path. If updating fails, the mirror is used
+    as it is.
+    """
+    mirror = Path(mirror_cache) / f"{repo_dir_name(url)}.git"
+    with clone_lock(mirror):
+        if not mirror.exists():
+            # Clone next to it first, so an interrupted clone is not mistaken
+            # for a mirror
+            partial_mirror = mirror.with_name(f"{mirror.name}.partial")
+            shutil.rmtree(partial_mirror, ignore_errors=True)
+            run_command(
+                ["git", "clone", "--quiet", "--bare", url,
+                 str(partial_mirror)],
+                env=GIT_ENV)
+            partial_mirror.rename(mirror)
+            return mirror
+        try:
+            run_command([
+                "git", "-C",
+                str(mirror), "fetch", "--quiet", "--prune", "origin",
+                "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"
+            ],
+                            env=GIT_ENV)
+        except RuntimeError as e:
+            print(
+                f"update_mirror: could not update {mirror}, using it as is: {e}",
+                file=sys.stderr)
+        return mirror
 
-def drop_git_ending(url):
-    url = url.rstrip("/")
-    if url[-4:] == ".git":
-        return url[:-4]
-    return url
+
+def clone_repo(url,
+               keep_files=False,
+               shallow=False,
+               mirror_cache=None,
+               workdir=Path("work"),
+               dirname=None):
+    """
+    Clone url into workdir/dirname (by default, its repository name), unless
+    keep_files is set and it is already there. A shallow clone only has the latest commit of the default branch. With a
+    mirror_cache directory, url is cloned from its mirror there, see
+    update_mirror(). Safe to call from several threads at once.
+    """
+    repo_path = workdir / (dirname or repo_name_from(url))
+    with clone_lock(repo_path):
+        if not keep_files:
+            shutil.rmtree(repo_path, ignore_errors=True)
+        if repo_path.exists():
+            return repo_path
+
+        source = url
+        if mirror_cache is not None:
+            # --depth is ignored for plain paths
+            source = update_mirror(url, mirror_cache).absolute().as_uri()
+        shallow_options = ["--depth=1", "--single-branch"] if shallow else []
+        run_command([
+            "git",
+            "clone",
+            #"--recurse-submodules",
+            "--quiet",
+            *shallow_options,
+            source,
+            str(repo_path),
+        ],
+                        env=GIT_ENV)
+        return repo_path
 
 
 def print_experiment(results):
@@ -161,11 +767,6 @@ def print_experiment(results):
     print(f"{polonius}\t{nll}\t{p}")
 
 
-def git_url_in_set(url, url_set):
-    return url in url_set or "{url}.git" in url_set or drop_git_ending(
-        url) in url_set
-
-
 def read_repo_file(repo_file):
     return {
         url.strip()
@@ -174,18 +775,31 @@ def read_repo_file(repo_file):
     }
 
 
+def not_blacklisted(repo_urls):
+    with open_registry() as conn:
+        urls = []
+        for url in repo_urls:
+            if is_blacklisted(conn, url):
+                print(f"clone_repos: {url} is blacklisted!", file=sys.stderr)
+            else:
+                urls.append(url)
+        return urls
+
+
 def clone_repos(repo_urls, keep_files=False):
+    """
+    Clone each of repo_urls that is not blacklisted, yielding the url and its
+    directory. Each is cloned into a directory of its own, see
+    repo_dir_name(), so that repositories with the same name can be
+    benchmarked at once.
+    """
     global NR_BENCHES
-    global BLACKLIST
 
     NR_BENCHES = len(repo_urls)
 
-    for url in repo_urls:
-        if git_url_in_set(url, BLACKLIST):
-            print(f"clone_repos: {url} is blacklisted!", file=sys.stderr)
-            continue
+    for url in not_blacklisted(repo_urls):
         try:
-            yield clone_repo(url, keep_files)
+            yield url, clone_repo(url, keep_files, dirname=repo_dir_name(url))
         except RuntimeError:
             print(
                 f"clone_repos: error cloning {url}, blacklisting it...",
@@ -193,15 +807,106 @@ def clone_repos(repo_urls, keep_files=False):
             blacklist_repo(url)
 
 
+def clone_repos_concurrently(repo_urls,
+                             slots,
+                             nr_threads=4,
+                             prepare=None,
+                             **clone_options):
+    """
+    Like clone_repos(), but clones nr_threads repositories at a time, into
+    their usual directories, and yields them as they are done. Each repository takes one of slots (a
+    Semaphore) before it is cloned, and the consumer releases it when done
+    with the repository, so cloning runs at most that far ahead. If given,
+    prepare is called on each cloned repository in the cloning thread.
+    """
+    global NR_BENCHES
+
+    NR_BENCHES = len(repo_urls)
+
+    def clone(url):
+        try:
+            repo = clone_repo(url, **clone_options)
+        except RuntimeError:
+            return url, None
+        if prepare is not None:
+            prepare(repo)
+        return url, repo
+
+    with ThreadPool(nr_threads) as pool:
+        for url, repo in pool.imap_unordered(
+                clone, throttled(not_blacklisted(repo_urls), slots)):
+            if repo is None:
+                print(
+                    f"clone_repos: error cloning {url}, blacklisting it...",
+                    file=sys.stderr)
+                blacklist_repo(url)
+                slots.release()
+                continue
+            yield url, repo
+
+
 def blacklist_repo(url):
-    global BLACKLIST
-    if not git_url_in_set(url, BLACKLIST):
-        BLACKLIST.add(url)
-        with open("blacklist.txt", "a") as fp:
-            fp.write(f"{url}\n")
+    record_status(url, FAILED, "could not be cloned", blacklist=True)
 
 
-if __name__ == '__main__':
+def benchmark_repo(job):
+    """
+    Run the experiments on the cloned repository directory and remove it
+    afterwards. Returns the url and directory, its results row, its borrowck
+    time per crate and the error that stopped it, if any.
+    """
+    url, directory, cached_deps, pass_timings = job
+    try:
+        row, crate_times = run_experiments(directory, cached_deps,
+                                           pass_timings)
+        return url, directory, [
+            repo_name_from(url), *row,
+            log_dir_of(directory)
+        ], crate_times, None
+    except RuntimeError as e:
+        return url, directory, None, None, e
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(target_dir_of(directory), ignore_errors=True)
+
+
+def throttled(iterable, slots):
+    """
+    Yield from iterable only while a slot of the semaphore slots is free,
+    taking one per item. The consumer releases a slot per finished item.
+    """
+    for item in iterable:
+        slots.acquire()
+        yield item
+
+
+def main():
+    global EMA
+    global PREVIOUS_RESULTS
+    global SEEN_REPOS
+
+    parser = argparse.ArgumentParser(
+        description="Compare cargo check runtimes under Polonius and NLL")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of repositories to benchmark at once")
+    parser.add_argument(
+        "--cached-deps",
+        action="store_true",
+        help="build dependencies once per repository, and only rebuild "
+        "its own crates in the timed runs")
+    parser.add_argument(
+        "--pass-timings",
+        action="store_true",
+        help="also measure the time spent in MIR borrowck with "
+        f"-Ztime-passes, per crate in {BORROWCK_RESULTS}")
+    args = parser.parse_args()
+
+    with open_registry() as conn:
+        ensure_imported(conn)
     try:
         with open("results.csv") as fp:
             PREVIOUS_RESULTS = list(csv.reader(fp))
@@ -209,33 +914,57 @@ if __name__ == '__main__':
     except FileNotFoundError:
         pass
 
-    with open("results.csv", "w") as csvfile:
+    # Keep at most one cloned repository waiting per worker
+    slots = threading.Semaphore(2 * args.jobs)
+    repos = throttled(
+        clone_repos(read_repo_file(pathlib.Path("repositories.txt"))), slots)
+    jobs = ((url, d, args.cached_deps, args.pass_timings)
+            for url, d in repos)
+
+    borrowck_path = BORROWCK_RESULTS if args.pass_timings else os.devnull
+    write_borrowck_header = args.pass_timings and not Path(
+        BORROWCK_RESULTS).is_file()
+    with open_registry() as conn, open("results.csv", "w") as csvfile, open(
+            borrowck_path, "a") as borrowck_file, mp.Pool(
+                args.jobs) as pool:
         writer = csv.writer(csvfile, delimiter=",")
-        if not PREVIOUS_RESULTS:
-            writer.writerow(["Repo", "Polonius Runtime", "NLL Runtime", "p"])
-        else:
-            for row in PREVIOUS_RESULTS:
+        borrowck_writer = csv.writer(borrowck_file, delimiter=",")
+        if write_borrowck_header:
+            borrowck_writer.writerow(BORROWCK_HEADER)
+        # Results from before the sample columns were added are kept, but
+        # the header is always the current one.
+        writer.writerow(RESULTS_HEADER)
+        if PREVIOUS_RESULTS:
+            for row in PREVIOUS_RESULTS[1:]:
                 writer.writerow(row)
-        prev_time = None
-        for i, d in enumerate(
-                clone_repos(pathlib.Path("repositories.txt")), start=1):
-            if prev_time is not None:
-                expired_time = time.time() - prev_time
-                EMA = expired_time if EMA is None else ALPHA * expired_time + (
-                    1 - ALPHA) * EMA
-                eta = datetime.timedelta(seconds=(NR_BENCHES - i) * EMA)
-            else:
-                eta = None
+        prev_time = time.time()
+        for i, (url, d, row, crate_times, error) in enumerate(
+                pool.imap_unordered(benchmark_repo, jobs), start=1):
+            slots.release()
+            name = repo_name_from(url)
+            # Time between finished repositories, so this accounts for
+            # the parallelism
+            expired_time = time.time() - prev_time
+            EMA = expired_time if EMA is None else ALPHA * expired_time + (
+                1 - ALPHA) * EMA
+            eta = datetime.timedelta(seconds=(NR_BENCHES - i) * EMA)
+            prev_time = time.time()
             print(
-                f"Benchmarking {d.stem}: it's {i}/{NR_BENCHES}. EMA = {EMA}s. ETA = {eta}",
+                f"Benchmarked {name}: it's {i}/{NR_BENCHES}. EMA = {EMA}s. ETA = {eta}",
                 end="\n")
-            prev_time = time.time()
-            try:
-                writer.writerow([d.stem, *run_experiments(d)])
-                csvfile.flush()
-            except RuntimeError as e:
-                with open(f"{d.stem}.failure", "w") as fp:
-                    fp.write(f"error running experiments: {e}")
+            if error is not None:
+                with open(f"{name}.failure", "w") as fp:
+                    fp.write(f"error running experiments: {error}\n")
+                    fp.write(f"logs: {log_dir_of(d)}\n")
+                record(conn, url, FAILED, f"error running experiments: {error}")
                 continue
-            finally:
-                shutil.rmtree(d, ignore_errors=True)
+            record(conn, url, "benchmarked")
+            writer.writerow(row)
+            csvfile.flush()
+            for crate, times in crate_times.items():
+                borrowck_writer.writerow([name, crate, *times])
+            borrowck_file.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,11 @@ import os
 import shutil
 
 from benchmark import inputs_or_workdir
-from parse_nll_facts import missing_facts
+from nll_facts import corpus_index, facts_location
 
 
 def validate_crates(dirs):
+    index = corpus_index(dirs)
     with open("missing-facts.csv", "w") as fp:
         writer = csv.writer(fp)
 
@@ -21,9 +22,10 @@ def validate_crates(dirs):
                 f"Validating repo {i}/{len(dirs)}...".ljust(
                     os.get_terminal_size(0).columns),
                 end="\r")
-            facts_path = p / "nll-facts"
             crate_name = p.stem
-            fact_files_missing = missing_facts(facts_path)
+            summary = index[p]
+            fact_files_missing = [facts_location(p)] if summary is None else (
+                summary["missing"])
 
             if fact_files_missing:
                 writer.writerow([
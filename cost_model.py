@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Fit a model of Polonius' solve-time on the fact sizes of an earlier run, for
+# use by benchmark-solving --cost-model.
+# cost_model.py repo-stats.csv > cost-model.json
+
+import csv
+import json
+import math
+import sys
+
+import numpy as np
+
+# Columns of facts.csv the solve-time is predicted from
+FEATURES = [
+    "borrow_region",
+    "cfg_edge",
+    "child",
+    "initialized_at",
+    "invalidates",
+    "killed",
+    "moved_out_at",
+    "outlives",
+    "path_accessed_at",
+    "path_belongs_to_var",
+    "universal_region",
+    "var_defined",
+    "var_drop_used",
+    "var_drops_region",
+    "var_used",
+    "var_uses_region",
+    "loans",
+    "variables",
+    "regions",
+    "cfg nodes",
+]
+
+# Functions that timed out are fitted as having taken this long, the
+# benchmark's soft timeout. Those that failed, or that an earlier run skipped
+# as predicted timeouts, say nothing about the solve-time and are left out.
+MISSING_RUNTIME = 5 * 60
+
+
+def feature_vector(facts_row):
+    return [1.0, *[math.log1p(float(facts_row[f])) for f in FEATURES]]
+
+
+def runtime_column(columns, algorithm):
+    for column in [f"min {algorithm} runtime", f"min(2) {algorithm} runtime"]:
+        if column in columns:
+            return column
+    return None
+
+
+def training_runtime(row, algorithm):
+    """
+    The runtime of algorithm to fit a row of repo-stats.csv with, or None if
+    the row is left out. Without a status column, as in files from before it
+    was added, an empty runtime is taken to be a timeout.
+    """
+    runtime = row[runtime_column(row.keys(), algorithm)]
+    status = row.get(f"{algorithm} status")
+    if status is None:
+        status = "ok" if runtime else "timeout"
+    if status == "ok":
+        return float(runtime)
+    if status.startswith("timeout"):
+        return MISSING_RUNTIME
+    return None
+
+
+def fit(rows, algorithms):
+    """
+    Fit log(runtime) as a linear function of the log of each feature, per
+    algorithm, by least squares. Rows of functions whose facts weren't
+    analysed are left out, and so are those training_runtime() leaves out.
+    """
+    rows = [row for row in rows if row.get("status", "ok") == "ok"]
+    weights = dict()
+    for algorithm in algorithms:
+        fitted = [(row, training_runtime(row, algorithm)) for row in rows]
+        fitted = [(row, runtime) for row, runtime in fitted
+                  if runtime is not None]
+        X = np.array([feature_vector(row) for row, _runtime in fitted])
+        y = np.log([runtime for _row, runtime in fitted])
+        weights[algorithm] = np.linalg.lstsq(X, y, rcond=None)[0].tolist()
+    return {"features": FEATURES, "weights": weights}
+
+
+def predict(model, facts_row):
+    """
+    The predicted solve-time in seconds of each algorithm on the function
+    described by a row of facts.csv.
+    """
+    x = np.array(feature_vector(facts_row))
+    return {
+        algorithm: float(np.exp(x @ np.array(w)))
+        for algorithm, w in model["weights"].items()
+    }
+
+
+def load_model(path):
+    with open(path) as fp:
+        model = json.load(fp)
+    assert model["features"] == FEATURES, f"{path} uses other features"
+    return model
+
+
+def load_facts(path):
+    """
+    Read facts.csv into a dictionary keyed by (program, function), leaving
+    out functions whose facts weren't analysed.
+    """
+    with open(path) as fp:
+        return {(row["program"], row["function"]): row
+                for row in csv.DictReader(fp)
+                if row.get("status", "ok") == "ok"}
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as fp:
+        stats = list(csv.DictReader(fp))
+    algorithms = [
+        a for a in ["Naive", "Hybrid", "DatafrogOpt"]
+        if runtime_column(stats[0].keys(), a)
+    ]
+    json.dump(fit(stats, algorithms), sys.stdout, indent=2)
+    print("")
@@ -1,28 +1,10 @@
 #!/usr/bin/env python3
 
-from benchmark import drop_git_ending
+from registry import repo_url_to_id
 from pathlib import Path
 import sys
 
 
-def username_and_repo_name(url):
-    components = url.split("/")
-    username, repo_name = components[-2:]
-    return (username, repo_name)
-
-
-def repo_url_to_id(url):
-    url = drop_git_ending(url)
-    if "github.com" in url:
-        return ("github", *username_and_repo_name(url))
-    if "gitlab.com" in url:
-        return ("gitlab", *username_and_repo_name(url))
-    if "bitbucket.org" in url:
-        return ("bitbucket", *username_and_repo_name(url))
-
-    return url
-
-
 def main():
     target_file = Path(sys.argv[1])
 
@@ -0,0 +1,273 @@
+# Find Rust repositories on crates.io and GitHub for find-repos.py. Pages are
+# fetched concurrently under a rate limit per source, responses are cached on
+# disk and revalidated with conditional requests, and each source resumes from
+# the last page it reached.
+
+import asyncio
+import hashlib
+import http.client
+import json
+import math
+import os
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+CACHE_DIR = Path(".discovery-cache")
+# The last page of each source whose repositories have all been seen, and
+# its number of pages
+STATE_PATH = CACHE_DIR / "state.json"
+CRATES_URL = "https://crates.io/api/v1/crates"
+GITHUB_SEARCH_URL = "https://api.github.com/search/repositories"
+CRATES_PER_PAGE = 100
+GITHUB_PER_PAGE = 100
+# GitHub only serves the first 1000 results of a search
+GITHUB_MAX_RESULTS = 1000
+USER_AGENT = "msc-polonius-fact-study"
+REQUEST_TIMEOUT = 60
+RETRIES = 5
+# How long to wait before retrying a request that failed to get a response,
+# in seconds, doubling with each attempt
+RETRY_DELAY = 5
+
+
+def rate_limiter(per_second):
+    """
+    Make an async function that returns once it is the caller's turn, at
+    most per_second times a second.
+    """
+    lock = asyncio.Lock()
+    next_time = 0.0
+
+    async def wait():
+        nonlocal next_time
+        async with lock:
+            now = time.monotonic()
+            if next_time > now:
+                await asyncio.sleep(next_time - now)
+            next_time = max(now, next_time) + 1 / per_second
+
+    return wait
+
+
+def cache_path(url):
+    return CACHE_DIR / f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+
+
+def read_cached(url):
+    try:
+        with open(cache_path(url)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def write_cached(url, headers, body):
+    CACHE_DIR.mkdir(exist_ok=True)
+    path = cache_path(url)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(
+            {
+                "url": url,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "body": body,
+            }, fp)
+    os.replace(tmp_path, path)
+
+
+def read_state():
+    try:
+        with open(STATE_PATH) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return dict()
+
+
+def save_progress(source, page, pages=None):
+    state = read_state()
+    state[source] = {"page": page, "pages": pages}
+    CACHE_DIR.mkdir(exist_ok=True)
+    tmp_path = STATE_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(state, fp)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def http_get(url, headers):
+    """
+    GET url, returning the status, headers and body text of the response,
+    whatever its status.
+    """
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(
+                request, timeout=REQUEST_TIMEOUT) as response:
+            return response.status, response.headers, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read().decode(errors="replace")
+
+
+def retry_delay(status, headers):
+    """
+    How long to wait before retrying a rate-limited request, or None if the
+    response wasn't rate-limited.
+    """
+    if headers.get("Retry-After"):
+        return float(headers["Retry-After"])
+    if status in (403, 429) and headers.get("X-RateLimit-Remaining") == "0":
+        return max(float(headers.get("X-RateLimit-Reset", 0)) - time.time(),
+                   1)
+    return None
+
+
+async def fetch_json(url, wait, headers=None):
+    """
+    Fetch and decode a JSON document, using the cached copy if the server
+    says it hasn't changed. wait is the source's rate_limiter().
+    """
+    cached = read_cached(url)
+    request_headers = {
+        "User-Agent": USER_AGENT,
+        "Accept": "application/json",
+        **(headers or {}),
+    }
+    if cached and cached["etag"]:
+        request_headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        request_headers["If-Modified-Since"] = cached["last_modified"]
+
+    for attempt in range(RETRIES):
+        await wait()
+        try:
+            status, response_headers, body = await asyncio.to_thread(
+                http_get, url, request_headers)
+        except (OSError, http.client.HTTPException) as e:
+            # Connection errors, resets and timeouts, including URLError
+            delay = RETRY_DELAY * 2**attempt
+            print(f"error fetching {url}: {e}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            continue
+        if status == 304 and cached:
+            return json.loads(cached["body"])
+        delay = retry_delay(status, response_headers)
+        if delay is not None:
+            print(f"rate limited by {url}, waiting {delay:.0f}s")
+            await asyncio.sleep(delay)
+            continue
+        if status >= 400:
+            raise RuntimeError(f"error fetching {url}: HTTP {status}: {body}")
+        write_cached(url, response_headers, body)
+        return json.loads(body)
+    raise RuntimeError(
+        f"error fetching {url}: no response after {RETRIES} attempts")
+
+
+async def fetch_pages(source,
+                      page_url,
+                      page_count,
+                      wait,
+                      concurrency,
+                      headers=None):
+    """
+    Fetch the pages of a paginated API, concurrency at a time, and yield
+    (page number, number of pages, body) in order. Starts after the last page
+    the source reached, see save_progress(), or over from the first page once
+    it has reached the last, so that new results are found and the cached
+    pages revalidated. page_count gives the number of pages from a page's
+    body.
+    """
+    state = read_state().get(source, dict())
+    page = state.get("page", 0) + 1
+    last_page = state.get("pages")
+    if last_page is not None and page > last_page:
+        page, last_page = 1, None
+    while last_page is None or page <= last_page:
+        # The number of pages is only known after the first one
+        end = page + 1 if last_page is None else min(page + concurrency,
+                                                     last_page + 1)
+        bodies = await asyncio.gather(*[
+            fetch_json(page_url(p), wait, headers) for p in range(page, end)
+        ])
+        for body in bodies:
+            last_page = page_count(body)
+            yield page, last_page, body
+            page += 1
+
+
+async def crates_io_repos(wait, concurrency, base_url=CRATES_URL):
+    """
+    Yield the page number, number of pages and repository URLs of each page
+    of crates on crates.io, by recent downloads.
+    """
+
+    def page_url(page):
+        return f"{base_url}?" + urllib.parse.urlencode({
+            "page": page,
+            "per_page": CRATES_PER_PAGE,
+            "sort": "recent_downloads"
+        })
+
+    def extract_url(crate):
+        return crate['repository'].replace("/tree/master/", "").rstrip("/")
+
+    pages = fetch_pages(
+        "crates.io", page_url,
+        lambda body: math.ceil(body["meta"]["total"] / CRATES_PER_PAGE),
+        wait, concurrency)
+    async for page, last_page, body in pages:
+        yield page, last_page, [
+            extract_url(c) for c in body["crates"] if c["repository"]
+        ]
+
+
+async def github_repos(wait, concurrency, token=None,
+                       base_url=GITHUB_SEARCH_URL):
+    """
+    Yield the page number, number of pages and clone URLs of each page of
+    Rust repositories on GitHub, by stars.
+    """
+
+    def page_url(page):
+        return f"{base_url}?" + urllib.parse.urlencode({
+            "q": "language:rust",
+            "sort": "stars",
+            "order": "desc",
+            "per_page": GITHUB_PER_PAGE,
+            "page": page
+        })
+
+    def page_count(body):
+        results = min(body["total_count"], GITHUB_MAX_RESULTS)
+        return math.ceil(results / GITHUB_PER_PAGE)
+
+    headers = {"Authorization": f"token {token}"} if token else None
+    pages = fetch_pages("github", page_url, page_count, wait, concurrency,
+                        headers)
+    async for page, last_page, body in pages:
+        yield page, last_page, [r["clone_url"] for r in body["items"]]
+
+
+async def discover(sources, on_repo):
+    """
+    Go through sources, a dictionary of async generators of (page, number of
+    pages, repository URLs) by name, concurrently, calling on_repo() on every URL. A source's
+    progress is saved once on_repo() has been called on all of a page. A
+    source that fails is reported and left at that page.
+    """
+
+    async def drain(source, pages):
+        try:
+            async for page, last_page, urls in pages:
+                for url in urls:
+                    on_repo(url)
+                save_progress(source, page, last_page)
+        except Exception as e:
+            # Only this source is given up on, the others carry on
+            print(f"discover: giving up on {source}: {e!r}")
+
+    await asyncio.gather(
+        *[drain(source, pages) for source, pages in sources.items()])
@@ -1,181 +1,205 @@
 #!/usr/bin/env python3
-import itertools
+import argparse
+import asyncio
+import datetime
+import multiprocessing as mp
 import os
 import shutil
-import sys
 import time
+from functools import partial
+from pathlib import Path
 
-import requests
-from github import Github
+from benchmark import (ALGORITHMS, BUILD_LIMITS, clone_repo, run_experiment,
+                       run_log, trim_target_dir)
+from discovery import (CRATES_URL, GITHUB_SEARCH_URL, crates_io_repos,
+                       discover, github_repos, rate_limiter, save_progress)
+from registry import (FAILED, ensure_imported, export_text_files,
+                      is_blacklisted, open_registry, record, status_of,
+                      urls_with_status)
 
-from benchmark import (ALGORITHMS, blacklist_repo, clone_repo, git_url_in_set,
-                       run_experiment)
-
-
-def populate_serialised_url_set(filename, sets_to_exclude=None):
-    url_set = set()
-    exclude = [url_set] if not sets_to_exclude else [url_set, *sets_to_exclude]
-    with open(filename) as fp:
-        for url in fp:
-            url = url.strip()
-            if not url:
-                continue
-            if not any([git_url_in_set(url, s) for s in exclude]):
-                url_set.add(url)
-            else:
-                print(f"Excluding duplicate url {url}")
-    return url_set
-
-
-BLACKLIST = populate_serialised_url_set("blacklist.txt")
-WHITELIST = populate_serialised_url_set(
-    "repositories.txt", sets_to_exclude=[BLACKLIST])
-
-SEEN = populate_serialised_url_set(
-    "repositories.seen.txt", sets_to_exclude=[WHITELIST, BLACKLIST])
 
 EMA = None
 ALPHA = 0.5
-CRATES_URL = "https://crates.io/api/v1/crates"
-
-
-def get_crates():
-    for i in itertools.count(start=1):
-        params = {"page": i, "per_page": 20, "sort": "recent_downloads"}
-        response = requests.get(CRATES_URL, params=params)
-        response.raise_for_status()
-        if response.json()['meta']['total'] == 0:
-            break
-        for crate in response.json()['crates']:
-            yield crate
-
-
-def get_crates_io_repos():
-    def extract_url(crate):
-        return crate['repository'].replace("/tree/master/", "").rstrip("/")
-
-    return (extract_url(c) for c in get_crates() if c['repository'])
-
-
-def get_github_repos():
-    gh = Github(os.environ['GH_ACCESS_TOKEN'], per_page=100)
-    repo_iterator = gh.search_repositories(
-        sort="stars", order="desc", query="language:rust")
-
-    rate_limit_remaining = gh.get_rate_limit().search.remaining
-    for i, r in enumerate(repo_iterator):
-        if i % 10 == 0:
-            rate_limit_remaining = gh.get_rate_limit().search.remaining
-
-        while rate_limit_remaining <= 1:
-            rate_limit_remaining = gh.get_rate_limit().search.remaining
-            remaining = gh.rate_limiting_resettime - time.time()
-            print("Hitting rate limit for GitHub!")
-            yield None
-
-        yield r.clone_url
-
-
-def verify_repo(url):
-    global EMA
+# Each verification worker clones into, and builds in, directories of its own
+# under here
+VERIFY_DIR = Path("verify")
+VERIFY_WORKDIR = Path("work")
+VERIFY_TARGET_DIR = None
+# A worker's target directory is kept between repositories, so that shared
+# dependencies are reused, but emptied once it has grown past this many
+# bytes. A lower limit uses less disk, at the cost of more rebuilding.
+VERIFY_TARGET_LIMIT = 10 * 2**30
+
+
+def verify_repo(url, workdir=Path("work"), target_dir=None):
+    """
+    Clone url into workdir and check that it compiles, building into
+    target_dir if given, returning its compile-time, or None if it doesn't.
+    """
     try:
-        path = clone_repo(url)
+        path = clone_repo(url, workdir=workdir)
     except RuntimeError:
         print(f"verify_repo: clone error for {url}")
-        return False
+        return None
     try:
-        results = run_experiment(ALGORITHMS[1], path)
-        EMA = results if EMA is None else ALPHA * results + (1 - ALPHA) * EMA
+        results, _usage, _borrowck = run_experiment(
+            ALGORITHMS[1],
+            path,
+            log=run_log(path, "verify"),
+            target_dir=target_dir,
+            limits=BUILD_LIMITS)
     except RuntimeError as e:
         print(
             f"====\nrepo {url} died:\n---\n{e}\n---\nskipping and blacklisting\n===="
         )
-        return False
+        return None
     finally:
         assert path.stem != "work", "Clone path is weird???"
         shutil.rmtree(path)
 
-    print(f"repo {url} compiled with results {results}, EMA: {EMA}")
-    return True
+    return results
 
 
-def interleave_iterators(iter_a, iter_b):
-    for a, b in itertools.zip_longest(iter_a, iter_b):
-        if a is not None:
-            yield a
-        if b is not None:
-            yield b
+def use_worker_dirs(worker_ids):
+    """
+    Pool initializer: clone into and build in the directories of the next
+    free worker ID.
+    """
+    global VERIFY_WORKDIR
+    global VERIFY_TARGET_DIR
+    worker_id = worker_ids.get()
+    VERIFY_WORKDIR = VERIFY_DIR / f"work-{worker_id}"
+    VERIFY_TARGET_DIR = (VERIFY_DIR / f"target-{worker_id}").absolute()
 
 
-def whitelist_repo(repo_url):
-    global WHITELIST
-    WHITELIST.add(repo_url)
-    with open("repositories.txt", "a") as fp:
-        fp.write(f"{repo_url}\n")
-        fp.flush()
+def verify_job(url):
+    start_time = time.time()
+    results = verify_repo(url, VERIFY_WORKDIR, VERIFY_TARGET_DIR)
+    if VERIFY_TARGET_DIR is not None:
+        trim_target_dir(VERIFY_TARGET_DIR, VERIFY_TARGET_LIMIT)
+    return url, results, time.time() - start_time
 
 
-def seen_repo(repo_url):
-    global SEEN
-    SEEN.add(repo_url)
-    with open("repositories.seen.txt", "a") as fp:
-        fp.write(f"{repo_url}\n")
-        fp.flush()
-
+def empty_inbox(conn, nr_workers=1):
+    """
+    Verify the seen repositories of the registry conn in nr_workers
+    processes. Only this process records the outcomes.
+    """
+    global EMA
 
-def empty_inbox():
-    print(f"Going through {len(SEEN)} collected unverified repos")
-    try:
-        for repo_url in SEEN:
-            if not git_url_in_set(repo_url, BLACKLIST) and not git_url_in_set(
-                    repo_url, WHITELIST):
-                verify_and_whitelist(repo_url)
-    finally:
-        print("Dumping repositories back...")
-        with open("repositories.seen.txt", "w") as fp:
-            for url in sorted(SEEN):
-                if not git_url_in_set(repo_url,
-                                      BLACKLIST) and not git_url_in_set(
-                                          repo_url, WHITELIST):
-                    fp.write(f"{url}\n")
-
-
-def verify_and_whitelist(repo_url):
-    if verify_repo(repo_url):
-        print(f"whitelisting: {repo_url}")
-        whitelist_repo(repo_url)
+    to_verify = urls_with_status(conn, "seen")
+    print(f"Going through {len(to_verify)} collected unverified repos")
+
+    worker_ids = mp.Queue()
+    for worker_id in range(nr_workers):
+        worker_ids.put(worker_id)
+
+    with mp.Pool(
+            nr_workers, initializer=use_worker_dirs,
+            initargs=(worker_ids, )) as pool:
+        # The time per repository is smoothed over all workers' results,
+        # which finish nr_workers at a time
+        repo_ema = None
+        for i, (repo_url, results, repo_time) in enumerate(
+                pool.imap_unordered(verify_job, to_verify), start=1):
+            repo_ema = repo_time if repo_ema is None else (
+                ALPHA * repo_time + (1 - ALPHA) * repo_ema)
+            eta = datetime.timedelta(
+                seconds=(len(to_verify) - i) * repo_ema / nr_workers)
+            if results is None:
+                print(f"blacklisting: {repo_url}")
+                record(
+                    conn,
+                    repo_url,
+                    FAILED,
+                    "did not clone or compile",
+                    blacklist=True)
+            else:
+                EMA = results if EMA is None else ALPHA * results + (
+                    1 - ALPHA) * EMA
+                print(
+                    f"repo {repo_url} compiled with results {results}, EMA: {EMA}"
+                )
+                print(f"whitelisting: {repo_url}")
+                record(conn, repo_url, "verified")
+            print(f"verified {i}/{len(to_verify)}. ETA = {eta}")
+
+
+def consider_repo(conn, repo_url):
+    status = status_of(conn, repo_url)
+    if is_blacklisted(conn, repo_url):
+        print(f"skipping blacklisted url {repo_url}...")
+    elif status == "seen":
+        print(f"skipping already-seen {repo_url}")
+    elif status is not None:
+        print(f"skipping already-verified {repo_url}")
     else:
-        print(f"blacklisting: {repo_url}")
-        blacklist_repo(repo_url)
+        record(conn, repo_url, "seen")
 
 
 if __name__ == '__main__':
-    count = 0
-    with open("repositories.txt", "w") as fp:
-        for url in sorted(WHITELIST):
-            fp.write(f"{url}\n")
-
-    SEEN -= WHITELIST
-    SEEN -= BLACKLIST
-
-    if sys.argv[1] == "empty-inbox":
-        ## go through the backlog from .seen.txt and verify_and_whitelist
-        if SEEN:
-            empty_inbox()
-            exit(0)
-
-    for repo_url in interleave_iterators(get_github_repos(),
-                                         get_crates_io_repos()):
-        if not repo_url:
-            continue
-        if git_url_in_set(repo_url, BLACKLIST):
-            print(f"skipping blacklisted url {repo_url}...")
-            continue
-        elif git_url_in_set(repo_url, WHITELIST):
-            print(f"skipping already-verified {repo_url}")
-            continue
-        elif git_url_in_set(repo_url, SEEN):
-            print(f"skipping already-seen {repo_url}")
-            continue
-
-        seen_repo(repo_url)
+    parser = argparse.ArgumentParser(
+        description="Find Rust repositories, and verify that they compile")
+    parser.add_argument(
+        "command",
+        choices=["get-new", "empty-inbox"],
+        help="find new repositories, or verify the ones found")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of repositories to verify at once")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="pages to fetch at once per source")
+    parser.add_argument(
+        "--crates-rate",
+        type=float,
+        default=1.0,
+        help="crates.io requests per second")
+    parser.add_argument(
+        "--github-rate",
+        type=float,
+        default=0.5,
+        help="GitHub requests per second")
+    parser.add_argument("--crates-url", default=CRATES_URL)
+    parser.add_argument("--github-url", default=GITHUB_SEARCH_URL)
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="start from the first page instead of where the last run was")
+    args = parser.parse_args()
+
+    if args.restart:
+        save_progress("crates.io", 0)
+        save_progress("github", 0)
+
+    async def get_new(conn):
+        # The limiters must be made inside the event loop
+        sources = {
+            "crates.io":
+            crates_io_repos(
+                rate_limiter(args.crates_rate), args.concurrency,
+                args.crates_url),
+            "github":
+            github_repos(
+                rate_limiter(args.github_rate), args.concurrency,
+                os.environ.get("GH_ACCESS_TOKEN"), args.github_url),
+        }
+        await discover(sources, partial(consider_repo, conn))
+
+    with open_registry() as conn:
+        ensure_imported(conn)
+        try:
+            if args.command == "empty-inbox":
+                ## go through the backlog of seen repositories and verify
+                ## them
+                empty_inbox(conn, args.jobs)
+            else:
+                asyncio.run(get_new(conn))
+        finally:
+            print("Exporting repositories back...")
+            export_text_files(conn)
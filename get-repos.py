@@ -2,37 +2,69 @@
 
 # get-repos repositories.txt
 
+import argparse
 import json
 import multiprocessing as mp
 import os
 import subprocess
 import sys
+import threading
 import time
+from functools import partial
 from pathlib import Path
 
-from benchmark import (chdir, clone_repos, read_repo_file, repo_name_from,
-                       run_command)
+from benchmark import (BUILD_LIMITS, CommandTimedOut,
+                       clone_repos_concurrently, read_repo_file,
+                       repo_name_from, run_command, run_log, trim_target_dir)
+from nll_facts import FACTS_DIR, crate_manifest, facts_location, pack_facts
+from registry import FAILED, ensure_imported, open_registry, record
 
 NLL_FACT_OPTIONS = "-Znll-facts"
 RUST_VERSION = "+stage1"
-HARD_TIMEOUT = "60m"
-SOFT_TIMEOUT = "30m"
+# Per-command deadlines, in seconds. Commands are sent SIGTERM after the soft
+# timeout and killed after the hard timeout.
+SOFT_TIMEOUT = 30 * 60
+HARD_TIMEOUT = 60 * 60
 ERROR_LOGFILE = Path.cwd() / "repo-errors.log"
 COMPLETED_LOGFILE = Path.cwd() / "repo-ok.csv"
 NR_WORKERS = 10
+NR_CLONE_WORKERS = 4
+# With --cargo-home, each worker builds into its own target directory under
+# here, kept between repositories so that dependencies are built only once.
+TARGET_CACHE = Path.cwd() / "collect-target-cache"
+# Nothing is ever removed from those target directories, so a worker's is
+# emptied between repositories once it has grown past this many bytes. A lower
+# limit uses less disk, at the cost of rebuilding dependencies more often.
+TARGET_CACHE_LIMIT = 20 * 2**30
+# The cargo environment of this worker's commands, see use_dependency_cache()
+COLLECT_ENV = dict()
 
 
-def run_with_timeout(command):
+def run_with_timeout(command, cwd, env):
     return run_command(
-        ["timeout", f"--kill-after={HARD_TIMEOUT}", SOFT_TIMEOUT, *command])
+        command,
+        cwd=cwd,
+        env=env,
+        timeout=SOFT_TIMEOUT,
+        kill_after=HARD_TIMEOUT - SOFT_TIMEOUT,
+        limits=BUILD_LIMITS,
+        log=run_log(cwd, "collect"))
 
 
-def get_facts_for_targets(package, targets):
+def get_facts_for_targets(repo, package, targets, env):
+    if "CARGO_TARGET_DIR" in env:
+        # The package's own crates may be fresh in a shared target directory,
+        # and would then not be compiled to give their facts
+        run_command(["cargo", RUST_VERSION, "clean", "--package", package],
+                    cwd=repo,
+                    env=env,
+                    log=run_log(repo, "collect"))
+
     if len(targets) == 1:
         run_with_timeout([
             "cargo", RUST_VERSION, "rustc", "--package", package, "--",
             "-Znll-facts"
-        ])
+        ], repo, env)
         return
 
     for target in targets:
@@ -41,24 +73,60 @@ def get_facts_for_targets(package, targets):
             run_with_timeout([
                 "cargo", RUST_VERSION, "rustc", "--package", package, "--bin",
                 bin_name, "--", "-Znll-facts"
-            ])
+            ], repo, env)
         elif "lib" in target['kind']:
             run_with_timeout([
                 "cargo", RUST_VERSION, "rustc", "--package", package, "--lib",
                 "--", "-Znll-facts"
-            ])
+            ], repo, env)
 
 
-def get_this_crates_facts():
+def get_repo_facts(repo, env):
+    """
+    Collect the facts of every target of every package of repo, running
+    cargo with the variables of env.
+    """
     packages = json.loads(
-        subprocess.run(
-            ["cargo", "metadata", "--no-deps", "--format-version=1"],
-            capture_output=True,
-            text=True,
-            check=True).stdout)['packages']
+        run_command(["cargo", "metadata", "--no-deps", "--format-version=1"],
+                    cwd=repo,
+                    env=env).stdout)['packages']
 
     for package in packages:
-        get_facts_for_targets(package['name'], package['targets'])
+        get_facts_for_targets(repo, package['name'], package['targets'],
+                              env)
+
+
+def fetch_dependencies(repo, cargo_home):
+    """
+    Fetch the dependencies of repo into cargo_home, so that it can be built
+    offline. Failures are only reported, as building it will fail too.
+    """
+    try:
+        run_command([
+            "cargo", RUST_VERSION, "fetch", "--manifest-path",
+            str(repo / "Cargo.toml")
+        ],
+                    env={"CARGO_HOME": cargo_home},
+                    timeout=SOFT_TIMEOUT,
+                    kill_after=HARD_TIMEOUT - SOFT_TIMEOUT,
+                    log=run_log(repo, "fetch"))
+    except CommandTimedOut as e:
+        print(f"fetch_dependencies: timed out on {repo}: {e}", file=sys.stderr)
+    except RuntimeError as e:
+        print(f"fetch_dependencies: {e}", file=sys.stderr)
+
+
+def use_dependency_cache(target_dirs, cargo_home):
+    """
+    Pool initializer: build offline, with the dependencies fetched into
+    cargo_home, into the next free target directory.
+    """
+    global COLLECT_ENV
+    COLLECT_ENV = {
+        "CARGO_HOME": cargo_home,
+        "CARGO_NET_OFFLINE": "true",
+        "CARGO_TARGET_DIR": target_dirs.get(),
+    }
 
 
 def rm_path(p):
@@ -73,25 +141,78 @@ def cleanup_repo(repo_path):
             rm_path(p)
 
 
-def do_collect_facts(repo):
+def do_collect_facts(job, pack=False):
+    """
+    Collect the facts of the repository cloned from url and clean it up, for a
+    job of url and its directory. Returns the job and the first error that
+    happened along the way, if any.
+    """
+    url, repo = job
+    error = None
     try:
-        with chdir(repo):
-            get_this_crates_facts()
-        return repo, None
+        get_repo_facts(repo, COLLECT_ENV)
     except Exception as e:
-        return repo, e
-    finally:
+        error = e
+    # Even if collecting failed, whatever facts there are are kept
+    try:
         cleanup_repo(repo)
+        crate_manifest(repo, rescan=True)
+        if pack and (repo / FACTS_DIR).is_dir():
+            pack_facts(repo)
+    except Exception as e:
+        error = error or e
+    if "CARGO_TARGET_DIR" in COLLECT_ENV:
+        trim_target_dir(COLLECT_ENV["CARGO_TARGET_DIR"], TARGET_CACHE_LIMIT)
+    return url, repo, error
 
 
 def has_nll_facts_folder(repo_url):
     repo_name = repo_name_from(repo_url)
-    facts_path = Path("./work") / repo_name / "nll-facts"
-    return facts_path.is_dir()
+    return facts_location(Path("./work") / repo_name).exists()
 
 
-def main(repo_file):
+def main():
+    parser = argparse.ArgumentParser(
+        description="Clone repositories and collect their NLL facts")
+    parser.add_argument("repo_file", help="file with one repository per line")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=NR_WORKERS,
+        help="number of repositories to collect facts from at once")
+    parser.add_argument(
+        "--clone-jobs",
+        type=int,
+        default=NR_CLONE_WORKERS,
+        help="number of repositories to clone at once")
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=NR_WORKERS,
+        help="number of cloned repositories to keep waiting for a worker")
+    parser.add_argument(
+        "--shallow",
+        action="store_true",
+        help="only clone the latest commit of the default branch")
+    parser.add_argument(
+        "--mirror-cache",
+        type=Path,
+        help="keep a bare mirror of each repository here, and clone from it")
+    parser.add_argument(
+        "--cargo-home",
+        type=Path,
+        help="fetch dependencies into this CARGO_HOME when cloning, and "
+        "build offline from it, reusing built dependencies")
+    parser.add_argument(
+        "--pack-facts",
+        action="store_true",
+        help="pack each repository's nll-facts into a compressed archive")
+    args = parser.parse_args()
+    repo_file = args.repo_file
     print(f"Reading repos from {repo_file}")
+    with open_registry() as conn:
+        ensure_imported(conn)
 
     # Assume every folder with an nll-facts folder contains all necessary
     # facts already:
@@ -105,23 +226,59 @@ def main(repo_file):
     ok_count = 0
 
     start_time = time.time()
-    with mp.Pool(NR_WORKERS) as pool:
-        jobs = pool.imap_unordered(do_collect_facts,
-                                   clone_repos(repos, keep_files=True))
+    # A repository holds one of these from when it starts cloning until its
+    # facts are collected
+    slots = threading.Semaphore(args.jobs + args.queue)
+    prepare = None
+    initializer = None
+    target_dirs = mp.Queue()
+    cargo_home = None
+    if args.cargo_home is not None:
+        cargo_home = args.cargo_home.absolute()
+        prepare = partial(fetch_dependencies, cargo_home=cargo_home)
+        initializer = use_dependency_cache
+        for i in range(args.jobs):
+            target_dirs.put(TARGET_CACHE / str(i))
+
+    with open_registry() as conn, mp.Pool(
+            args.jobs,
+            initializer=initializer,
+            initargs=(target_dirs, cargo_home)) as pool:
+        cloned = clone_repos_concurrently(
+            repos,
+            slots,
+            args.clone_jobs,
+            prepare=prepare,
+            keep_files=True,
+            shallow=args.shallow,
+            mirror_cache=args.mirror_cache)
+        jobs = pool.imap_unordered(
+            partial(do_collect_facts, pack=args.pack_facts), cloned)
 
         with open(COMPLETED_LOGFILE, "w") as ok_fp, open(ERROR_LOGFILE,
                                                          "w") as err_fp:
-            for i, (repo, error) in enumerate(jobs, start=1):
+            for i, (url, repo, error) in enumerate(jobs, start=1):
+                slots.release()
                 if error:
-                    err_fp.write(f"{repo.stem}\n{error}\n")
+                    timed_out = isinstance(error, CommandTimedOut)
+                    outcome = (f"timed out after {error.elapsed:.0f}s"
+                               if timed_out else "failed")
+                    err_fp.write(f"{repo.stem}\n{outcome}: {error}\n")
+                    err_fp.write(f"log: {run_log(repo, 'collect')}\n")
                     err_fp.write("======\n")
                     err_fp.flush()
                     err_count += 1
+                    record(conn, url, FAILED,
+                           f"collecting facts {outcome}: {error}")
                 else:
-                    ok_fp.write(f"{repo.stem},{time.time()}\n")
+                    ok_fp.write(
+                        f"{repo.stem},{time.time()},{run_log(repo, 'collect')}\n"
+                    )
                     ok_fp.flush()
                     ok_count += 1
-                status = "Done" if not error else "Error"
+                    record(conn, url, "collected")
+                status = "Done" if not error else (
+                    "Timeout" if isinstance(error, CommandTimedOut) else "Error")
                 print(
                     f"E: {err_count} OK: {ok_count}: {status} processing repo {i}/{len(repos)}: {repo}"
                     .ljust(os.get_terminal_size(0).columns),
@@ -136,4 +293,4 @@ def main(repo_file):
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main()
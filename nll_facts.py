@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+# Access to a crate's nll-facts, either as the nll-facts directory rustc writes
+# or packed into a single compressed archive, nll-facts.zip. The archive has a
+# directory entry per function, followed by its <relation>.facts files.
+# Each crate also gets a manifest of its functions and their facts, and
+# nll-facts.index.json summarises the manifests of the whole corpus, so that
+# the tools needn't walk millions of files.
+# nll_facts.py [--link-duplicates|--reindex] <my-crate> <my-other-crate> packs
+# the crates' nll-facts, replaces duplicated functions with hard links, or
+# rebuilds their manifests and the index.
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+from benchmark import inputs_or_workdir
+
+FACTS_DIR = "nll-facts"
+ARCHIVE_NAME = "nll-facts.zip"
+# Archived functions are extracted here when they are needed as directories
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+# A crate's functions, and the digest and sizes of their facts, see
+# crate_manifest()
+MANIFEST_NAME = "nll-facts.manifest.json"
+# A summary of each crate's manifest, see corpus_index()
+INDEX_PATH = Path("nll-facts.index.json")
+FACT_NAMES = [
+    "borrow_region",
+    "cfg_edge",
+    "child",
+    "initialized_at",
+    "invalidates",
+    "killed",
+    "moved_out_at",
+    "outlives",
+    "path_accessed_at",
+    "path_belongs_to_var",
+    "universal_region",
+    "var_defined",
+    "var_drop_used",
+    "var_drops_region",
+    "var_used",
+    "var_uses_region",
+]
+
+
+def facts_location(crate_path):
+    """
+    Where crate_path's facts are: its nll-facts directory, or its archive if
+    there is one but no directory.
+    """
+    facts_path = crate_path / FACTS_DIR
+    archive_path = crate_path / ARCHIVE_NAME
+    if not facts_path.is_dir() and archive_path.is_file():
+        return archive_path
+    return facts_path
+
+
+def is_archive(location):
+    return location.name == ARCHIVE_NAME
+
+
+def is_archived(fn_path):
+    return is_archive(fn_path.parent)
+
+
+@lru_cache(maxsize=8)
+def _open_archive(archive_path, pid, mtime_ns):
+    return zipfile.ZipFile(archive_path)
+
+
+def open_archive(archive_path):
+    """
+    Open an archive for reading, reusing it between calls. Processes don't
+    share them, as their reads would move each other's file offset.
+    """
+    return _open_archive(archive_path, os.getpid(),
+                         os.stat(archive_path).st_mtime_ns)
+
+
+def fn_paths(location):
+    """
+    The paths of the functions at a facts location. The functions of an
+    archive get paths below it, like archive_path / function name.
+    """
+    assert isinstance(location, Path), "must be a Path"
+    if is_archive(location):
+        return [
+            location / name.rstrip("/")
+            for name in open_archive(location).namelist()
+            if name.endswith("/") and not name[0] == "."
+        ]
+    with os.scandir(location) as entries:
+        return [
+            location / e.name for e in entries
+            if e.is_dir() and not e.name[0] == "."
+        ]
+
+
+def fact_names(fn_path):
+    """
+    The relations a function has .facts files for, sorted.
+    """
+    if is_archived(fn_path):
+        prefix = f"{fn_path.name}/"
+        return sorted(
+            name[len(prefix):-len(".facts")]
+            for name in open_archive(fn_path.parent).namelist()
+            if name.startswith(prefix) and name.endswith(".facts"))
+    with os.scandir(fn_path) as entries:
+        return sorted(e.name[:-len(".facts")] for e in entries
+                      if e.name.endswith(".facts"))
+
+
+def fact_exists(fn_path, relation):
+    if is_archived(fn_path):
+        try:
+            open_archive(fn_path.parent).getinfo(
+                f"{fn_path.name}/{relation}.facts")
+            return True
+        except KeyError:
+            return False
+    return (fn_path / f"{relation}.facts").is_file()
+
+
+def open_fact(fn_path, relation):
+    """
+    Open a function's facts of a relation as text, decompressing archived
+    ones as they are read.
+    """
+    if is_archived(fn_path):
+        return io.TextIOWrapper(
+            open_archive(fn_path.parent).open(
+                f"{fn_path.name}/{relation}.facts"))
+    return open(fn_path / f"{relation}.facts")
+
+
+def crate_fingerprint(crate_path):
+    """
+    Fingerprint a crate's nll-facts tree by the names, sizes and modification
+    times of its .facts files, or of its archive.
+    """
+    digest = hashlib.sha1()
+    facts_path = facts_location(crate_path)
+    if is_archive(facts_path):
+        stat = facts_path.stat()
+        digest.update(
+            f"{facts_path.name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+    for dir_path, dir_names, file_names in os.walk(facts_path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".facts"):
+                continue
+            path = os.path.join(dir_path, file_name)
+            stat = os.stat(path)
+            digest.update(
+                f"{os.path.relpath(path, facts_path)}\t{stat.st_size}\t{stat.st_mtime_ns}\n"
+                .encode())
+    return digest.hexdigest()
+
+
+def scan_fn(fn_path):
+    """
+    Read a function's .facts files, returning the digest of their names and
+    contents, so that functions with identical facts get the same digest,
+    and the number of bytes and lines of each relation.
+    """
+    digest = hashlib.sha1()
+    sizes = dict()
+    for relation in fact_names(fn_path):
+        digest.update(f"{relation}\n".encode())
+        with open_fact(fn_path, relation) as fp:
+            facts = fp.read().encode()
+        digest.update(f"{len(facts)}\n".encode())
+        digest.update(facts)
+        sizes[relation] = [len(facts), facts.count(b"\n")]
+    return {"digest": digest.hexdigest(), "facts": sizes}
+
+
+def write_json(path, value):
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(value, fp)
+    os.replace(tmp_path, path)
+
+
+def crate_manifest(crate_path, rescan=False):
+    """
+    The manifest of crate_path's facts, or None if it has none: the scan_fn()
+    of each function by name, and the crate_fingerprint() of its facts when
+    it was made. It is kept in MANIFEST_NAME in the crate, and the facts are
+    only scanned again when the fingerprint has changed, so also when a
+    .facts file is rewritten in place, or if rescan is set.
+    """
+    location = facts_location(crate_path)
+    if not location.exists():
+        return None
+    stamp = crate_fingerprint(crate_path)
+    manifest_path = crate_path / MANIFEST_NAME
+    if not rescan:
+        try:
+            with open(manifest_path) as fp:
+                manifest = json.load(fp)
+            if manifest["stamp"] == stamp:
+                return manifest
+        except (FileNotFoundError, ValueError):
+            pass
+
+    manifest = {
+        "stamp": stamp,
+        "functions": {p.name: scan_fn(p)
+                      for p in fn_paths(location)},
+    }
+    write_json(manifest_path, manifest)
+    return manifest
+
+
+def indexed_fn_paths(crate_path):
+    """
+    Like fn_paths() of crate_path's facts location, from its manifest.
+    """
+    manifest = crate_manifest(crate_path)
+    if manifest is None:
+        return []
+    location = facts_location(crate_path)
+    return [location / name for name in manifest["functions"]]
+
+
+def fn_digests(crate_path):
+    """
+    The content digest of each of crate_path's functions (see scan_fn()), by
+    function name as in the CSV rows (the stem of its path).
+    """
+    manifest = crate_manifest(crate_path)
+    if manifest is None:
+        return dict()
+    return {
+        Path(name).stem: fn["digest"]
+        for name, fn in manifest["functions"].items()
+    }
+
+
+def missing_facts(location):
+    """
+    The .facts files missing from the functions at the facts location, or
+    the location itself if it is missing.
+    """
+    manifest = crate_manifest(location.parent)
+    if manifest is None or not location.exists():
+        return [location]
+    return manifest_missing_facts(location, manifest)
+
+
+def manifest_missing_facts(location, manifest):
+    return [
+        location / name / f"{relation}.facts"
+        for name, fn in manifest["functions"].items()
+        for relation in FACT_NAMES if relation not in fn["facts"]
+    ]
+
+
+def crate_summary(crate_path, rescan=False):
+    """
+    The corpus index entry of crate_path: the stamp, number of functions,
+    bytes and lines of facts and missing .facts files of its manifest, or
+    None if it has no facts.
+    """
+    manifest = crate_manifest(crate_path, rescan)
+    if manifest is None:
+        return None
+    sizes = [
+        size for fn in manifest["functions"].values()
+        for size in fn["facts"].values()
+    ]
+    return {
+        "stamp": manifest["stamp"],
+        "functions": len(manifest["functions"]),
+        "bytes": sum(size[0] for size in sizes),
+        "lines": sum(size[1] for size in sizes),
+        "missing": [
+            str(p) for p in manifest_missing_facts(
+                facts_location(crate_path), manifest)
+        ],
+    }
+
+
+def summary_is_fresh(crate_path, summary):
+    location = facts_location(crate_path)
+    if summary is None:
+        return not location.exists()
+    return location.exists() and crate_fingerprint(
+        crate_path) == summary["stamp"]
+
+
+def corpus_index(crate_paths, nr_workers=None, rescan=False):
+    """
+    The crate_summary() of each of crate_paths, by path, from INDEX_PATH.
+    The summaries of crates whose facts have changed since are made again,
+    nr_workers crates at a time, and saved to it.
+    """
+    try:
+        with open(INDEX_PATH) as fp:
+            index = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        index = dict()
+    stale = [
+        p for p in crate_paths if rescan or str(p) not in index
+        or not summary_is_fresh(p, index[str(p)])
+    ]
+    if stale:
+        print(f"indexing the facts of {len(stale)} crates", file=sys.stderr)
+        with mp.Pool(nr_workers) as pool:
+            summaries = pool.starmap(crate_summary,
+                                     [(p, rescan) for p in stale])
+        for crate_path, summary in zip(stale, summaries):
+            index[str(crate_path)] = summary
+        write_json(INDEX_PATH, index)
+    return {p: index[str(p)] for p in crate_paths}
+
+
+def link_duplicates(crate_paths):
+    """
+    Replace the .facts files of every function that is identical to one
+    seen before with hard links to the first one's. Archived crates are
+    left alone. Returns the number of functions linked.
+    """
+    first_seen = dict()
+    linked = 0
+    for crate_path in crate_paths:
+        location = facts_location(crate_path)
+        if is_archive(location):
+            continue
+        digests = fn_digests(crate_path)
+        for fn_path in fn_paths(location):
+            original = first_seen.setdefault(digests[fn_path.stem], fn_path)
+            if original == fn_path:
+                continue
+            for relation in fact_names(fn_path):
+                fact_path = fn_path / f"{relation}.facts"
+                tmp_path = fact_path.with_suffix(".tmp")
+                os.link(original / f"{relation}.facts", tmp_path)
+                os.replace(tmp_path, fact_path)
+            linked += 1
+    return linked
+
+
+@contextmanager
+def extracted(fn_paths):
+    """
+    Make directories of the functions in fn_paths, returning their paths.
+    Archived functions are extracted to a scratch directory in SCRATCH_DIR,
+    which is removed afterwards.
+    """
+    if not any(is_archived(p) for p in fn_paths):
+        yield list(fn_paths)
+        return
+    with tempfile.TemporaryDirectory(
+            prefix="nll-facts-", dir=SCRATCH_DIR) as scratch:
+        fn_dirs = []
+        for p in fn_paths:
+            if not is_archived(p):
+                fn_dirs.append(p)
+                continue
+            archive = open_archive(p.parent)
+            for name in archive.namelist():
+                if name.startswith(f"{p.name}/"):
+                    archive.extract(name, scratch)
+            fn_dirs.append(Path(scratch) / p.name)
+        yield fn_dirs
+
+
+def pack_facts(crate_path):
+    """
+    Pack the nll-facts directory of crate_path into an archive next to it,
+    and remove the directory.
+    """
+    facts_path = crate_path / FACTS_DIR
+    archive_path = crate_path / ARCHIVE_NAME
+    manifest = crate_manifest(crate_path)
+    tmp_path = archive_path.with_suffix(".tmp")
+    with zipfile.ZipFile(
+            tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for fn_path in sorted(fn_paths(facts_path)):
+            archive.write(fn_path, f"{fn_path.name}/")
+            for fact_path in sorted(fn_path.glob("*.facts")):
+                archive.write(fact_path, f"{fn_path.name}/{fact_path.name}")
+    os.replace(tmp_path, archive_path)
+    shutil.rmtree(facts_path)
+    # The functions are the same, only their location has changed
+    write_json(crate_path / MANIFEST_NAME, {
+        **manifest, "stamp": crate_fingerprint(crate_path)
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pack the nll-facts of crates into archives.")
+    parser.add_argument(
+        "crates",
+        nargs="*",
+        help="crate directories (default: everything in work/)")
+    parser.add_argument(
+        "--link-duplicates",
+        action="store_true",
+        help="instead hard-link the facts of functions identical to ones in "
+        "other crates, storing them once")
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help=f"instead scan the crates' facts again, rewriting their "
+        f"manifests and {INDEX_PATH}")
+    args = parser.parse_args()
+
+    crate_paths = inputs_or_workdir(args.crates)
+    if args.reindex:
+        corpus_index(crate_paths, rescan=True)
+        return
+    if args.link_duplicates:
+        linked = link_duplicates(crate_paths)
+        print(f"linked {linked} duplicated functions", file=sys.stderr)
+        return
+    for crate_path in crate_paths:
+        if (crate_path / FACTS_DIR).is_dir():
+            print(f"packing {crate_path}", file=sys.stderr)
+            pack_facts(crate_path)
+
+
+if __name__ == '__main__':
+    main()
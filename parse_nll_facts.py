@@ -1,49 +1,95 @@
 #!/usr/bin/env python3
+import argparse
 import csv
+import io
+import itertools
+import multiprocessing as mp
 import os
 import re
 import resource
 import shutil
+import signal
 import sys
-from collections import namedtuple
+import time
+from collections import Counter, defaultdict, namedtuple
+from multiprocessing.connection import wait
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
-import networkx as nx
-
-from benchmark import inputs_or_workdir, run_command
-
-FACT_NAMES = [
-    "borrow_region",
-    "cfg_edge",
-    "child",
-    "initialized_at",
-    "invalidates",
-    "killed",
-    "moved_out_at",
-    "outlives",
-    "path_accessed_at",
-    "path_belongs_to_var",
-    "universal_region",
-    "var_defined",
-    "var_drop_used",
-    "var_drops_region",
-    "var_used",
-    "var_uses_region",
-]
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from benchmark import (close_checkpoint, commit_checkpoint, inputs_or_workdir,
+                       open_checkpoint)
+from nll_facts import (FACT_NAMES, crate_fingerprint, facts_location,
+                       fn_digests, indexed_fn_paths, is_archive, is_archived,
+                       open_fact)
+
+FACT_ARITY = {
+    "borrow_region": 3,
+    "cfg_edge": 2,
+    "child": 2,
+    "initialized_at": 2,
+    "invalidates": 2,
+    "killed": 2,
+    "moved_out_at": 2,
+    "outlives": 3,
+    "path_accessed_at": 2,
+    "path_belongs_to_var": 2,
+    "universal_region": 1,
+    "var_defined": 2,
+    "var_drop_used": 2,
+    "var_drops_region": 2,
+    "var_used": 2,
+    "var_uses_region": 2,
+}
+
+# Interned, binary copies of a function's facts, written next to the .facts
+# files by --build-cache. See write_fact_cache() for the layout.
+FACT_CACHE_NAME = "facts.cache"
+FACT_CACHE_MAGIC = b"NLLFACTS"
+FACT_CACHE_VERSION = 2
 
 MAX_MEM_BYTES_SOFT = 8 * (1024**3)
 MAX_MEM_BYTES_HARD = 10 * (1024**3)
-SOFT_TIMEOUT = "30m"
-HARD_TIMEOUT = "35m"
+# Per-function deadlines, in seconds. Workers give up on a function after the
+# soft timeout and are killed after the hard timeout. Either way, the function
+# gets a marker row, see marker_row().
+SOFT_TIMEOUT = 5 * 60
+HARD_TIMEOUT = 6 * 60
+NR_WORKERS = os.cpu_count()
+
+# Rows of previously analysed crates, see stored_results(). Bump the version
+# when the rows change.
+FACTS_STORE = Path(".facts-store")
+FACTS_STORE_VERSION = 2
+
+FACTS_HEADER = [
+    "program",
+    "function",
+    *FACT_NAMES,
+    "loans",
+    "variables",
+    "regions",
+    "cfg nodes",
+    "cfg density",
+    "cfg transitivity",
+    "cfg number of attracting components",
+    "status",
+]
 
-FnFacts = namedtuple("FnFacts", ['name', *FACT_NAMES])
-Point = namedtuple("Point", ['level', 'block', 'offset'])
+# Every relation is a (tuples x arity) uint32 array of indices into symbols,
+# the function's table of interned atoms.
+FnFacts = namedtuple("FnFacts", ['name', 'symbols', *FACT_NAMES])
+# Matches the basic block of a point on the format '"Mid(bb5030[1])"'
+POINT_BLOCK_RE = re.compile(r"\(bb(\d+)\[")
 
 
-def read_tuples(path):
-    assert isinstance(path, Path), "must be a Path"
+def read_tuples(fn_path, field):
+    assert isinstance(fn_path, Path), "must be a Path"
 
-    with open(path) as fp:
+    with open_fact(fn_path, field) as fp:
         for line in fp:
             tpl = line\
                 .strip()\
@@ -53,127 +99,598 @@ def read_tuples(path):
             yield tpl
 
 
-def read_fn_nll_facts(fn_path):
+def intern_fn_facts(fn_path):
+    """
+    Read a function's .facts files, interning every atom into an integer ID.
+    Returns the symbol table and a uint32 array of IDs per relation.
+    """
     assert isinstance(fn_path, Path), "must be a Path"
-    #print(f"reading {fn_path}", file=sys.stderr)
-    return FnFacts(
-        **{
-            "name": fn_path.stem,
-            **{
-                field: list(read_tuples(fn_path / f"{field}.facts"))
-                for field in FACT_NAMES
-            }
-        })
+    symbol_ids = dict()
+    relations = dict()
+    for field in FACT_NAMES:
+        atom_ids = np.fromiter(
+            (symbol_ids.setdefault(atom, len(symbol_ids))
+             for tpl in read_tuples(fn_path, field)
+             for atom in tpl),
+            dtype=np.uint32)
+        relations[field] = atom_ids.reshape(-1, FACT_ARITY[field])
+    return list(symbol_ids), relations
+
+
+def write_fact_cache(fn_path):
+    """
+    Convert a function's .facts files into a single binary cache file.
+
+    Layout: the magic bytes, a little-endian uint32 header [version,
+    number of symbols, symbol table size in bytes, then (arity, number of
+    tuples) for each relation in FACT_NAMES], the relations as row-major
+    uint32 arrays and finally the newline-separated, UTF-8 symbol table.
+    Everything but the symbol table is 4-byte aligned so it can be mapped
+    straight into memory.
+    """
+    symbols, relations = intern_fn_facts(fn_path)
+    symbol_bytes = "\n".join(symbols).encode()
+    header = [FACT_CACHE_VERSION, len(symbols), len(symbol_bytes)]
+    for field in FACT_NAMES:
+        header.extend(relations[field].shape[::-1])
+
+    cache_path = fn_path / FACT_CACHE_NAME
+    tmp_path = cache_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as fp:
+        fp.write(FACT_CACHE_MAGIC)
+        fp.write(np.array(header, dtype="<u4").tobytes())
+        for field in FACT_NAMES:
+            fp.write(relations[field].astype("<u4").tobytes())
+        fp.write(symbol_bytes)
+    os.replace(tmp_path, cache_path)
+
+
+def read_fact_cache(cache_path):
+    """
+    Memory-map a cache written by write_fact_cache(). Returns the symbol
+    table and a (read-only) uint32 array per relation.
+    """
+    buf = np.memmap(cache_path, dtype=np.uint8, mode="r")
+    offset = len(FACT_CACHE_MAGIC)
+    assert bytes(buf[:offset]) == FACT_CACHE_MAGIC, f"{cache_path}: bad magic"
+    header_len = 3 + 2 * len(FACT_NAMES)
+    header = buf[offset:offset + 4 * header_len].view("<u4").tolist()
+    version, nr_symbols, symbols_len = header[:3]
+    assert version == FACT_CACHE_VERSION, f"{cache_path}: unknown version"
+    offset += 4 * header_len
+
+    relations = dict()
+    for i, field in enumerate(FACT_NAMES):
+        arity, nr_tuples = header[3 + 2 * i:5 + 2 * i]
+        nbytes = 4 * arity * nr_tuples
+        relations[field] = buf[offset:offset + nbytes]\
+            .view("<u4")\
+            .reshape(nr_tuples, arity)
+        offset += nbytes
+
+    symbols = bytes(buf[offset:offset + symbols_len]).decode().split("\n")
+    return symbols[:nr_symbols], relations
+
+
+def fact_cache_version(cache_path):
+    with open(cache_path, "rb") as fp:
+        magic = fp.read(len(FACT_CACHE_MAGIC))
+        version = np.frombuffer(fp.read(4), dtype="<u4")
+    if magic != FACT_CACHE_MAGIC or not version.size:
+        return None
+    return int(version[0])
+
+
+def fact_cache_is_fresh(fn_path):
+    if is_archived(fn_path):
+        return False
+    try:
+        cache_path = fn_path / FACT_CACHE_NAME
+        cache_mtime = cache_path.stat().st_mtime_ns
+        if fact_cache_version(cache_path) != FACT_CACHE_VERSION:
+            return False
+        return all(
+            (fn_path / f"{field}.facts").stat().st_mtime_ns <= cache_mtime
+            for field in FACT_NAMES)
+    except FileNotFoundError:
+        return False
 
 
-def nll_fn_paths(facts_path):
-    assert isinstance(facts_path, Path), "must be a Path"
-    return (p for p in facts_path.iterdir()
-            if p.is_dir() and not p.stem[0] == ".")
+def read_fn_nll_facts(fn_path):
+    assert isinstance(fn_path, Path), "must be a Path"
+    #print(f"reading {fn_path}", file=sys.stderr)
+    if fact_cache_is_fresh(fn_path):
+        symbols, relations = read_fact_cache(fn_path / FACT_CACHE_NAME)
+    else:
+        symbols, relations = intern_fn_facts(fn_path)
+    return FnFacts(name=fn_path.stem, symbols=symbols, **relations)
 
 
 def facts_to_row(fn_facts):
     assert isinstance(fn_facts, FnFacts), "must be a FnFacts instance!"
-    return [fn_facts.name, *[len(fact) for fact in fn_facts[1:]]]
-
-
-def missing_facts(d):
-    files_missing = []
-    if not d.is_dir():
-        return [d]
-    for fn_dir in d.iterdir():
-        if fn_dir.is_dir() and not fn_dir.stem[0] == ".":
-            for fact_name in FACT_NAMES:
-                fact_file = fn_dir / Path(f"{fact_name}.facts")
-                if not fact_file.is_file():
-                    files_missing.append(fact_file)
-                    continue
+    return [
+        fn_facts.name, *[len(getattr(fn_facts, field)) for field in FACT_NAMES]
+    ]
+
 
-    return files_missing
+def count_unique(*columns):
+    return int(np.unique(np.concatenate(columns)).size)
 
 
 def unique_loans(fn_facts):
-    loans = {l for (_r, l, _p) in fn_facts.borrow_region}
-    loans |= {l for (l, _p) in fn_facts.killed}
-    loans |= {l for (_p, l) in fn_facts.invalidates}
-    return len(loans)
+    return count_unique(
+        fn_facts.borrow_region[:, 1],
+        fn_facts.killed[:, 0],
+        fn_facts.invalidates[:, 1],
+    )
 
 
 def unique_variables(fn_facts):
-    variables = {v for (v, _p) in fn_facts.var_used}
-    variables |= {v for (v, _p) in fn_facts.var_defined}
-    variables |= {v for (v, _p) in fn_facts.var_drop_used}
-    variables |= {v for (v, _r) in fn_facts.var_uses_region}
-    variables |= {v for (v, _r) in fn_facts.var_drops_region}
-    return len(variables)
+    return count_unique(
+        fn_facts.var_used[:, 0],
+        fn_facts.var_defined[:, 0],
+        fn_facts.var_drop_used[:, 0],
+        fn_facts.var_uses_region[:, 0],
+        fn_facts.var_drops_region[:, 0],
+    )
 
 
 def unique_regions(fn_facts):
-    regions = {r for (r, _l, _p) in fn_facts.borrow_region}
-    regions |= {r for (_v, r) in fn_facts.var_uses_region}
-    regions |= {r for (_v, r) in fn_facts.var_drops_region}
-    regions |= {r1 for (r1, _r2, p) in fn_facts.outlives}
-    regions |= {r2 for (_r1, r2, p) in fn_facts.outlives}
-    return len(regions)
+    return count_unique(
+        fn_facts.borrow_region[:, 0],
+        fn_facts.var_uses_region[:, 1],
+        fn_facts.var_drops_region[:, 1],
+        fn_facts.outlives[:, 0],
+        fn_facts.outlives[:, 1],
+    )
+
+
+def build_crate_cache(crate_path):
+    location = facts_location(crate_path)
+    if is_archive(location):
+        # Archived facts are always read from the archive
+        return crate_path
+    for fn_path in indexed_fn_paths(crate_path):
+        if not fact_cache_is_fresh(fn_path):
+            write_fact_cache(fn_path)
+    return crate_path
+
+
+def build_cache_main(crate_paths):
+    """
+    Convert the .facts files of every crate into binary caches, once.
+    """
+    with mp.Pool() as pool:
+        for i, crate_path in enumerate(
+                pool.imap_unordered(build_crate_cache, crate_paths), start=1):
+            print(
+                f"cached crate #{i}/{len(crate_paths)}: {crate_path.stem}"\
+                .ljust(os.get_terminal_size(0).columns),
+                file=sys.stderr,
+                end="\r")
+    print("", file=sys.stderr)
 
 
-def run_external_analysis(crate_path):
-    # call myself with different args
-    return run_command([
-        "timeout", f"--kill-after={HARD_TIMEOUT}", SOFT_TIMEOUT, sys.argv[0],
-        str(crate_path)
-    ]).stdout
+def raise_timeout(signum, frame):
+    raise TimeoutError(f"analysis took longer than {SOFT_TIMEOUT}s")
 
 
-def dirs_to_csv(dirs, out_fp):
-    writer = csv.writer(out_fp)
-    writer.writerow([
-        "program",
-        "function",
-        *FACT_NAMES,
-        "loans",
-        "variables",
-        "regions",
-        "cfg nodes",
-        "cfg density",
-        "cfg transitivity",
-        "cfg number of attracting components",
-    ])
-
-    for crate_count, crate_path in enumerate(dirs):
-        print(
-            f"processing crate #{crate_count}/{len(dirs)}: {crate_path.stem}"\
-            .ljust(os.get_terminal_size(0).columns),
-            file=sys.stderr,
-            end="\r")
+def analysis_worker(tasks, results, first_task=None):
+    """
+    Analyse crates, except for the functions to skip, from first_task and
+    then the tasks queue until it yields None. Sends ("started", crate,
+    pid), ("function", crate, (pid, function)) as each function is started,
+    ("row", crate, row) and ("done", crate, error) messages back on the
+    results connection. Messages are sent as they happen, so none are lost
+    if the worker is killed.
+    """
+    set_ulimit()
+    signal.signal(signal.SIGALRM, raise_timeout)
+    pending = iter(tasks.get, None)
+    if first_task is not None:
+        pending = itertools.chain([first_task], pending)
+    for crate_idx, crate_path, skip in pending:
+        results.send(("started", crate_idx, os.getpid()))
+
+        def started(fn_name):
+            results.send(("function", crate_idx, (os.getpid(), fn_name)))
+
+        error = None
         try:
-            out_fp.write(run_external_analysis(crate_path))
-        except RuntimeError as e:
-            print(f"\n====Error\n{e}\n=====", file=sys.stderr)
+            for row in crate_rows(crate_path, skip, started):
+                results.send(("row", crate_idx, row))
+        except Exception as e:
+            error = f"error analysing {crate_path}: {e!r}"
+        results.send(("done", crate_idx, error))
 
 
-def parse_point(p):
+def analysis_pool(crate_paths, nr_workers, skipped=None):
+    """
+    Analyse crate_paths in nr_workers processes, yielding the workers'
+    messages as they arrive, except repeated "started" and "function" ones.
+    skipped holds the names of the functions not to analyse of each crate,
+    if any. Workers that die or overrun HARD_TIMEOUT on a function are
+    killed, the function gets a marker row, and a new worker goes on with
+    the rest of the crate. Workers that die outside of a function are
+    replaced, and their crate is reported done with an error, as are any
+    crates still unfinished once no workers are left.
+    """
+    tasks = mp.Queue()
+    skip = [
+        set(skipped[crate_idx]) if skipped else set()
+        for crate_idx in range(len(crate_paths))
+    ]
+    for crate_idx, crate_path in enumerate(crate_paths):
+        tasks.put((crate_idx, crate_path, frozenset(skip[crate_idx])))
+
+    def start_worker(first_task=None):
+        # A pipe per worker, so that killing one can't garble the others'
+        # messages
+        reader, writer = mp.Pipe(duplex=False)
+        worker = mp.Process(
+            target=analysis_worker,
+            args=(tasks, writer, first_task),
+            daemon=True)
+        worker.start()
+        writer.close()
+        workers[worker.pid] = worker
+        readers[reader] = worker.pid
+
+    workers = dict()
+    readers = dict()
+    for _ in range(min(nr_workers, len(crate_paths))):
+        tasks.put(None)
+        start_worker()
+
+    def messages():
+        """
+        The messages that have arrived within a second. Readers of workers
+        that have exited are closed once everything they sent is read.
+        """
+        for reader in wait(list(readers), timeout=1):
+            try:
+                yield reader.recv()
+            except EOFError:
+                del readers[reader]
+                reader.close()
+
+    # The crate and function each worker is on, and when it started it
+    running = dict()
+    # How many workers that died between crates may be replaced
+    restarts_left = nr_workers
+    started = set()
+    finished = set()
+    while len(finished) < len(crate_paths):
+        for kind, crate_idx, payload in messages():
+            if crate_idx in finished:
+                continue
+            if kind == "started":
+                running[payload] = (crate_idx, None, time.time())
+                if crate_idx in started:
+                    continue
+                started.add(crate_idx)
+            elif kind == "function":
+                pid, fn_name = payload
+                running[pid] = (crate_idx, fn_name, time.time())
+                continue
+            elif kind == "row":
+                skip[crate_idx].add(payload[1])
+            elif kind == "done":
+                finished.add(crate_idx)
+                running = {
+                    pid: job
+                    for pid, job in running.items() if job[0] != crate_idx
+                }
+            yield kind, crate_idx, payload
+
+        open_pids = set(readers.values())
+        for pid, (crate_idx, fn_name, start_time) in list(running.items()):
+            worker = workers[pid]
+            overdue = fn_name is not None and (time.time() - start_time >
+                                               HARD_TIMEOUT)
+            # A dead worker's messages are all read before it's given up on
+            if not overdue and (worker.is_alive() or pid in open_pids):
+                continue
+            worker.kill()
+            worker.join()
+            del running[pid]
+            del workers[pid]
+            # Anything an overdue worker sent since is no longer wanted
+            for reader in [r for r, p in readers.items() if p == pid]:
+                del readers[reader]
+                reader.close()
+            if fn_name is None:
+                finished.add(crate_idx)
+                yield "done", crate_idx, f"worker analysing {crate_paths[crate_idx]} died ({worker.exitcode})"
+                start_worker()
+                continue
+            if fn_name not in skip[crate_idx]:
+                status = "timeout" if overdue else f"died ({worker.exitcode})"
+                skip[crate_idx].add(fn_name)
+                yield "row", crate_idx, marker_row(
+                    crate_paths[crate_idx].stem, fn_name, status)
+            start_worker((crate_idx, crate_paths[crate_idx],
+                          frozenset(skip[crate_idx])))
+
+        # Workers that exited between crates either ran out of tasks or died
+        # waiting for one, which is retried a limited number of times
+        for pid, worker in list(workers.items()):
+            if pid in running or worker.is_alive() or pid in open_pids:
+                continue
+            worker.join()
+            del workers[pid]
+            if worker.exitcode != 0 and restarts_left > 0:
+                restarts_left -= 1
+                tasks.put(None)
+                start_worker()
+        # A crate can be lost with a worker that died as it took it
+        if not workers:
+            for crate_idx, crate_path in enumerate(crate_paths):
+                if crate_idx not in finished:
+                    finished.add(crate_idx)
+                    yield "done", crate_idx, f"no worker left to analyse {crate_path}"
+
+
+def stored_results(crate_path, fingerprint):
     """
-    Parse a point on the format '"Mid(bb5030[1])"'
+    The CSV rows stored for crate_path by an earlier run, or None if there
+    are none or they were computed from a different nll-facts tree.
     """
-    p = p.replace("\\", "").replace("'", "").replace('"', "")
-    return Point(*re.match(r"(.+)\(bb(.+)\[(\d+)\]\)", p).groups())
+    try:
+        with open(FACTS_STORE / f"{crate_path.name}.csv", newline="") as fp:
+            if fp.readline().strip() == f"{FACTS_STORE_VERSION}:{fingerprint}":
+                return fp.read()
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def store_results(crate_path, fingerprint, rows_csv):
+    FACTS_STORE.mkdir(exist_ok=True)
+    store_path = FACTS_STORE / f"{crate_path.name}.csv"
+    tmp_path = store_path.with_suffix(".tmp")
+    with open(tmp_path, "w", newline="") as fp:
+        fp.write(f"{FACTS_STORE_VERSION}:{fingerprint}\n")
+        fp.write(rows_csv)
+    os.replace(tmp_path, store_path)
+
+
+def evict_stored_results(crate_paths):
+    """
+    Remove stored results for crates that are no longer in crate_paths.
+    """
+    keep = {f"{p.name}.csv" for p in crate_paths}
+    if not FACTS_STORE.is_dir():
+        return
+    for store_path in FACTS_STORE.iterdir():
+        if store_path.name not in keep:
+            store_path.unlink()
+
+
+def rows_to_csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue()
+
+
+def dirs_to_csv(dirs, out_fp, nr_workers=NR_WORKERS, checkpoint=None):
+    """
+    Write the statistics of each function of the crates in dirs to out_fp
+    as soon as it is analysed, so rows of different crates are interleaved.
+    If writing to a checkpoint, its header is already written, each row is
+    committed to its journal as (crate, function), and each crate as
+    (crate, ) once all its rows are. Functions committed by an earlier run
+    are not written again.
+
+    Functions with the same facts as one before them in dirs (see
+    fn_digests()) are not analysed, but get a copy of its statistics.
+    """
+    writer = csv.writer(out_fp)
+    if checkpoint is None:
+        writer.writerow(FACTS_HEADER)
+    # The functions of each crate an interrupted run has written already
+    written = defaultdict(set)
+    for key in checkpoint.done if checkpoint is not None else []:
+        if len(key) == 2:
+            written[key[0]].add(key[1])
+
+    with ThreadPool() as pool:
+        fingerprints = pool.map(crate_fingerprint, dirs)
+        digests = pool.map(fn_digests, dirs)
+
+    # The statistics of every function whose facts are shared with others,
+    # by digest, and the copies waiting for them as (crate, function)
+    digest_counts = Counter(d for fns in digests for d in fns.values())
+    shared_stats = dict()
+    waiting = defaultdict(list)
+    # The rows of each unfinished crate, and how many of its copies are
+    # still waiting
+    crate_rows = defaultdict(list)
+    copies_left = Counter()
+    analysed = set()
+    failed = set()
+
+    def add_row(crate_idx, row):
+        crate_rows[crate_idx].append(row)
+        if row[-1] != "ok":
+            # Analyse the function again next run, maybe with more time
+            failed.add(crate_idx)
+        if row[1] not in written[dirs[crate_idx].name]:
+            writer.writerow(row)
+            if checkpoint is not None:
+                commit_checkpoint(
+                    checkpoint, dirs[crate_idx].name, row[1], sync=False)
+            else:
+                out_fp.flush()
+        digest = digests[crate_idx].get(row[1])
+        if digest_counts[digest] < 2 or digest in shared_stats:
+            return
+        shared_stats[digest] = row[2:]
+        for copy_idx, fn_name in waiting.pop(digest, []):
+            copies_left[copy_idx] -= 1
+            add_row(copy_idx, [dirs[copy_idx].stem, fn_name, *row[2:]])
+            finish_crate(copy_idx)
+
+    def finish_crate(crate_idx):
+        """
+        Store and commit crate_idx once it has been analysed and has all its
+        copies. Only crates analysed in one go with no marker rows are
+        stored.
+        """
+        if crate_idx not in analysed or copies_left[crate_idx]:
+            return
+        crate_path = dirs[crate_idx]
+        rows = crate_rows.pop(crate_idx, [])
+        if crate_idx not in failed and not written[crate_path.name]:
+            store_results(crate_path, fingerprints[crate_idx],
+                          rows_to_csv(rows))
+        if checkpoint is not None:
+            commit_checkpoint(checkpoint, crate_path.name)
+
+    def copy_skipped(crate_idx, fn_names):
+        """
+        Copy the statistics of the functions fn_names of crate_idx from their
+        originals, now or once they are done.
+        """
+        for fn_name in sorted(fn_names):
+            digest = digests[crate_idx][fn_name]
+            if digest in shared_stats:
+                add_row(crate_idx,
+                        [dirs[crate_idx].stem, fn_name, *shared_stats[digest]])
+            else:
+                waiting[digest].append((crate_idx, fn_name))
+                copies_left[crate_idx] += 1
+
+    # Crates that haven't changed since the last run are finished already
+    to_analyse = []
+    for crate_idx, crate_path in enumerate(dirs):
+        rows_csv = stored_results(crate_path, fingerprints[crate_idx])
+        if rows_csv is None:
+            to_analyse.append(crate_idx)
+            continue
+        for row in csv.reader(io.StringIO(rows_csv)):
+            add_row(crate_idx, row)
+        analysed.add(crate_idx)
+        finish_crate(crate_idx)
+    print(
+        f"{len(dirs) - len(to_analyse)} crates unchanged, analysing {len(to_analyse)}",
+        file=sys.stderr)
+
+    # The first of each set of identical functions is analysed, the others
+    # are skipped and copied from it once it is done. Functions written
+    # before are skipped too, and can't be originals.
+    skipped = dict()
+    copied = dict()
+    claimed = set(shared_stats)
+    for crate_idx in to_analyse:
+        done = written[dirs[crate_idx].name]
+        copied[crate_idx] = set()
+        for fn_name, digest in digests[crate_idx].items():
+            if fn_name in done or digest_counts[digest] < 2:
+                continue
+            if digest in claimed:
+                copied[crate_idx].add(fn_name)
+            claimed.add(digest)
+        skipped[crate_idx] = frozenset(done | copied[crate_idx])
+    print(
+        f"skipping {sum(map(len, copied.values()))} duplicated functions",
+        file=sys.stderr)
+
+    started_count = 0
+    for kind, job_idx, payload in analysis_pool(
+        [dirs[i] for i in to_analyse], nr_workers,
+        [skipped[i] for i in to_analyse]):
+        crate_idx = to_analyse[job_idx]
+        if kind == "started":
+            started_count += 1
+            print(
+                f"processing crate #{started_count}/{len(to_analyse)}: {dirs[crate_idx].stem}"\
+                .ljust(os.get_terminal_size(0).columns),
+                file=sys.stderr,
+                end="\r")
+        elif kind == "row":
+            add_row(crate_idx, payload)
+        elif kind == "done":
+            if payload:
+                print(f"\n====Error\n{payload}\n=====", file=sys.stderr)
+                failed.add(crate_idx)
+            analysed.add(crate_idx)
+            copy_skipped(crate_idx, copied[crate_idx])
+            finish_crate(crate_idx)
+
+    # Copies of functions whose crate failed before getting to them have no
+    # statistics, and get marker rows, which also keep their crates from
+    # being stored
+    while waiting:
+        _digest, copies = waiting.popitem()
+        for copy_idx, fn_name in copies:
+            copies_left[copy_idx] -= 1
+            add_row(copy_idx,
+                    marker_row(dirs[copy_idx].stem, fn_name, "failed"))
+            finish_crate(copy_idx)
+
+
+def point_blocks(points):
+    """
+    Extract the basic block number of each point in one regex pass over all
+    of them.
+    """
+    blocks = POINT_BLOCK_RE.findall("\n".join(points))
+    assert len(blocks) == len(points), "malformed point in cfg_edge"
+    return np.array(blocks, dtype=np.int64)
 
 
 def block_cfg_from_facts(facts):
+    """
+    Build the CFG between basic blocks as a sparse adjacency matrix. Edges
+    within a block are dropped, and only blocks with an edge to or from
+    another block become nodes.
+    """
     assert isinstance(facts, FnFacts), "must be a FnFacts instance!"
-    G = nx.DiGraph()
+    points, point_idx = np.unique(facts.cfg_edge, return_inverse=True)
+    blocks = point_blocks([facts.symbols[p] for p in points.tolist()])
+    edges = blocks[point_idx].reshape(-1, 2)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+
+    nodes, node_idx = np.unique(edges, return_inverse=True)
+    node_idx = node_idx.reshape(-1, 2)
+    cfg = csr_matrix(
+        (np.ones(len(node_idx), dtype=np.int64), (node_idx[:, 0],
+                                                   node_idx[:, 1])),
+        shape=(len(nodes), len(nodes)))
+    cfg.data[:] = 1  # parallel edges were summed
+    return cfg
+
 
-    for edge in facts.cfg_edge:
-        start, end = [parse_point(p).block for p in edge]
-        if start != end:
-            G.add_edge(start, end)
-    return G
+def cfg_density(cfg):
+    nr_nodes = cfg.shape[0]
+    if cfg.nnz == 0 or nr_nodes <= 1:
+        return 0
+    return cfg.nnz / (nr_nodes * (nr_nodes - 1))
 
 
-def main(args):
-    repos = inputs_or_workdir()
-    dirs_to_csv(repos, sys.stdout)
+def cfg_transitivity(cfg):
+    """
+    Transitivity as networkx computes it for a DiGraph, where each node's
+    neighbours are its successors.
+    """
+    out_degree = np.diff(cfg.indptr)
+    possible = int((out_degree * (out_degree - 1)).sum())
+    triangles = int(cfg.multiply(cfg @ cfg.T).sum())
+    return 0 if triangles == 0 else triangles / possible
+
+
+def cfg_attracting_components(cfg):
+    """
+    The number of strongly connected components without edges leaving them.
+    """
+    if cfg.shape[0] == 0:
+        return 0
+    nr_components, labels = connected_components(
+        cfg, directed=True, connection="strong")
+    sources, targets = cfg.nonzero()
+    leaving = labels[sources] != labels[targets]
+    return nr_components - np.unique(labels[sources[leaving]]).size
 
 
 def set_ulimit():
@@ -181,39 +698,102 @@ def set_ulimit():
                        (MAX_MEM_BYTES_SOFT, MAX_MEM_BYTES_HARD))
 
 
-def do_analysis(crate_path):
-    crate_name = crate_path.stem
-    facts_path = crate_path / "nll-facts"
-    writer = csv.writer(sys.stdout)
-    for fn_path in nll_fn_paths(facts_path):
-        fn_facts = read_fn_nll_facts(fn_path)
-        cfg = block_cfg_from_facts(fn_facts)
-        crate_name = crate_path.stem
-        writer.writerow([
-            crate_name,
-            *facts_to_row(fn_facts),
-            unique_loans(fn_facts),
-            unique_variables(fn_facts),
-            unique_regions(fn_facts),
-            cfg.number_of_nodes(),
-            nx.density(cfg),
-            nx.transitivity(cfg),
-            nx.number_attracting_components(cfg),
-        ])
-
-
-def single_main(args):
-    """
-    This main function is called if we were called like parse_nll_facts
-    <path-to-a-crate>.
+def fn_row(crate_name, fn_path):
+    fn_facts = read_fn_nll_facts(fn_path)
+    cfg = block_cfg_from_facts(fn_facts)
+    return [
+        crate_name,
+        *facts_to_row(fn_facts),
+        unique_loans(fn_facts),
+        unique_variables(fn_facts),
+        unique_regions(fn_facts),
+        cfg.shape[0],
+        cfg_density(cfg),
+        cfg_transitivity(cfg),
+        cfg_attracting_components(cfg),
+        "ok",
+    ]
+
+
+def marker_row(crate_name, fn_name, status):
+    """
+    The row of a function that could not be analysed, with empty statistics
+    and the reason as its status.
+    """
+    return [crate_name, fn_name, *[""] * (len(FACTS_HEADER) - 3), status]
+
 
+def crate_rows(crate_path, skip=frozenset(), started=None):
     """
-    set_ulimit()
-    do_analysis(Path(sys.argv[1]))
+    Yield the row of each function of crate_path, except those in skip,
+    calling started() with the name of each before analysing it. Each
+    function has SOFT_TIMEOUT seconds and the worker's memory to itself;
+    functions that overrun them or fail get a marker_row() instead.
+    """
+    crate_name = crate_path.stem
+    for fn_path in indexed_fn_paths(crate_path):
+        if fn_path.stem in skip:
+            continue
+        if started is not None:
+            started(fn_path.stem)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, SOFT_TIMEOUT)
+            try:
+                row = fn_row(crate_name, fn_path)
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except TimeoutError:
+            row = marker_row(crate_name, fn_path.stem, "timeout")
+        except MemoryError:
+            row = marker_row(crate_name, fn_path.stem, "out of memory")
+        except Exception as e:
+            print(f"error analysing {fn_path}: {e!r}", file=sys.stderr)
+            row = marker_row(crate_name, fn_path.stem, "failed")
+        yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute summary statistics on the nll-facts of crates.")
+    parser.add_argument(
+        "crates",
+        nargs="*",
+        help="crate directories to analyse (default: everything in work/)")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=NR_WORKERS,
+        help=f"number of worker processes (default: {NR_WORKERS})")
+    parser.add_argument(
+        "--build-cache",
+        action="store_true",
+        help="convert the .facts files into binary caches instead")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="write to this file instead of stdout, and resume from where "
+        "an interrupted run left it")
+    args = parser.parse_args()
+
+    crate_paths = inputs_or_workdir(args.crates)
+    if args.build_cache:
+        build_cache_main(crate_paths)
+        return
+
+    if args.output:
+        checkpoint = open_checkpoint(args.output, FACTS_HEADER)
+        dirs_to_csv(
+            [p for p in crate_paths if (p.name, ) not in checkpoint.done],
+            checkpoint.out_fp,
+            nr_workers=args.jobs,
+            checkpoint=checkpoint)
+        close_checkpoint(checkpoint)
+    else:
+        dirs_to_csv(crate_paths, sys.stdout, nr_workers=args.jobs)
+    if not args.crates:
+        evict_stored_results(crate_paths)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        main(sys.argv)
-    else:
-        single_main(sys.argv)
+    main()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+# A SQLite registry of every repository found, and how far it has come:
+# seen -> verified -> collected -> benchmarked, or failed along the way.
+# Repositories are keyed by a canonical ID, so the same repository under
+# different URLs is only registered once. Any number of processes can update
+# it at once.
+# registry.py import|export|status
+
+import argparse
+import csv
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+REGISTRY_PATH = Path("registry.sqlite")
+STATUSES = ["seen", "verified", "collected", "benchmarked"]
+FAILED = "failed"
+# How long to wait for another process's transaction, in seconds
+BUSY_TIMEOUT = 60
+
+# reached is the furthest of STATUSES a repository has got to, even if it
+# then failed. Blacklisted repositories are not to be tried again. name is
+# the name of the repository's directory in work/, see record_by_name().
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    reached TEXT NOT NULL,
+    blacklisted INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS repos_status ON repos (status);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+"""
+# Made once registries from before the name column have it, see
+# open_registry()
+NAME_INDEX = "CREATE INDEX IF NOT EXISTS repos_name ON repos (name)"
+# The text files of URLs that are both imported and exported, and how their
+# URLs are recorded when imported
+URL_FILES = {
+    "repositories.seen.txt": ("seen", None, False),
+    "repositories.txt": ("verified", None, False),
+    "blacklist.txt": (FAILED, "imported from blacklist.txt", True),
+}
+
+
+def drop_git_ending(url):
+    url = url.rstrip("/")
+    if url[-4:] == ".git":
+        return url[:-4]
+    return url
+
+
+def repo_name_from(url):
+    return url.split("/")[-1].split(".git")[0]
+
+
+def username_and_repo_name(url):
+    components = url.split("/")
+    username, repo_name = components[-2:]
+    return (username, repo_name)
+
+
+def repo_url_to_id(url):
+    url = drop_git_ending(url)
+    if "github.com" in url:
+        return ("github", *username_and_repo_name(url))
+    if "gitlab.com" in url:
+        return ("gitlab", *username_and_repo_name(url))
+    if "bitbucket.org" in url:
+        return ("bitbucket", *username_and_repo_name(url))
+
+    return url
+
+
+def repo_id(url):
+    """
+    The canonical ID of a repository URL, as a string.
+    """
+    url_id = repo_url_to_id(url.strip())
+    if isinstance(url_id, tuple):
+        return "/".join(url_id).lower()
+    return url_id
+
+
+def has_name_column(conn):
+    return "name" in [
+        column[1] for column in conn.execute("PRAGMA table_info(repos)")
+    ]
+
+
+@contextmanager
+def open_registry(path=REGISTRY_PATH):
+    """
+    Connect to the registry at path, creating it if needed. Each with block
+    of the connection is a transaction.
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    try:
+        # Let readers go on while another process writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if not has_name_column(conn):
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if not has_name_column(conn):
+                    conn.create_function("repo_name", 1, repo_name_from)
+                    conn.execute("ALTER TABLE repos ADD COLUMN name TEXT "
+                                 "NOT NULL DEFAULT ''")
+                    conn.execute("UPDATE repos SET name = repo_name(url)")
+        conn.execute(NAME_INDEX)
+        yield conn
+    finally:
+        conn.close()
+
+
+def record(conn, url, status, message=None, blacklist=False):
+    """
+    Record that the repository at url has reached status, or failed with
+    message if status is FAILED. A repository only moves forward through
+    STATUSES, unless it failed before. Returns its previous status, or None
+    if it is new.
+    """
+    assert status in STATUSES or status == FAILED, f"unknown status {status}"
+    now = time.time()
+    with conn:
+        # Take the write lock up front, so the update is based on what we
+        # read
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT status, reached FROM repos WHERE id = ?",
+                           (repo_id(url), )).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO repos (id, url, name, status, reached, "
+                "blacklisted, message, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (repo_id(url), url.strip(), repo_name_from(url.strip()),
+                 status, status if status != FAILED else STATUSES[0],
+                 int(blacklist), message, now))
+            return None
+
+        previous, reached = row
+        if status == FAILED:
+            conn.execute(
+                "UPDATE repos SET status = ?, message = ?, updated = ?, "
+                "blacklisted = blacklisted OR ? WHERE id = ?",
+                (FAILED, message, now, int(blacklist), repo_id(url)))
+        elif previous == FAILED or STATUSES.index(status) > STATUSES.index(
+                reached):
+            conn.execute(
+                "UPDATE repos SET status = ?, reached = ?, message = NULL, "
+                "updated = ? WHERE id = ?",
+                (status, max(status, reached, key=STATUSES.index), now,
+                 repo_id(url)))
+        return previous
+
+
+def record_status(url, status, message=None, blacklist=False,
+                  path=REGISTRY_PATH):
+    """
+    record() with a connection of its own, for use from any thread or
+    process.
+    """
+    with open_registry(path) as conn:
+        return record(conn, url, status, message, blacklist)
+
+
+def status_of(conn, url):
+    row = conn.execute("SELECT status FROM repos WHERE id = ?",
+                       (repo_id(url), )).fetchone()
+    return row[0] if row else None
+
+
+def is_blacklisted(conn, url):
+    row = conn.execute("SELECT blacklisted FROM repos WHERE id = ?",
+                       (repo_id(url), )).fetchone()
+    return bool(row and row[0])
+
+
+def urls_with_status(conn, status):
+    return [
+        url for url, in conn.execute(
+            "SELECT url FROM repos WHERE status = ? AND NOT blacklisted "
+            "ORDER BY id", (status, ))
+    ]
+
+
+def read_url_file(path):
+    try:
+        with open(path) as fp:
+            return [
+                url.strip() for url in fp
+                if url.strip() and not url.strip()[0] == "#"
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def record_by_name(conn, name, status, message=None):
+    """
+    Record status for the registered repositories called name, which is all
+    results.csv and the work/ directories know them by. As repositories can
+    share a name, this is only for importing those; everything else records
+    by url.
+    """
+    urls = [
+        url for url, in conn.execute(
+            "SELECT url FROM repos WHERE name = ?", (name, ))
+    ]
+    for url in urls:
+        record(conn, url, status, message)
+    return urls
+
+
+def import_text_files(conn):
+    """
+    Register the repositories of the text files used before the registry:
+    repositories.seen.txt, repositories.txt, blacklist.txt, results.csv, the
+    *.failure files and the collected facts in work/.
+    """
+    from nll_facts import facts_location
+
+    for path in URL_FILES:
+        import_url_file(conn, path)
+    if Path("work").is_dir():
+        for crate_path in Path("work").iterdir():
+            if facts_location(crate_path).exists():
+                record_by_name(conn, crate_path.name, "collected")
+    try:
+        with open("results.csv") as fp:
+            for row in list(csv.reader(fp))[1:]:
+                record_by_name(conn, row[0], "benchmarked")
+    except FileNotFoundError:
+        pass
+    for failure_path in Path(".").glob("*.failure"):
+        record_by_name(conn, failure_path.stem, FAILED,
+                       failure_path.read_text())
+    mark_synced(conn)
+
+
+def import_url_file(conn, path, added_only=False):
+    """
+    Record the URLs of path, one of URL_FILES. With added_only, only those
+    the registry does not have yet, or does not have blacklisted yet for
+    blacklist.txt, are recorded, leaving the others as they are.
+    """
+    status, message, blacklist = URL_FILES[path]
+    for url in read_url_file(path):
+        if added_only and (is_blacklisted(conn, url) if blacklist else
+                           status_of(conn, url) is not None):
+            continue
+        record(conn, url, status, message, blacklist)
+
+
+def mark_synced(conn):
+    """
+    Note that the text files and the registry agree as of now, see
+    import_edited_files().
+    """
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced', ?)",
+                     (time.time(), ))
+
+
+def import_edited_files(conn):
+    """
+    Import the URLs added to those of URL_FILES that have been changed since
+    they were last imported or exported, so that URLs added by hand (to
+    blacklist a repository, say) are not lost when they are exported again.
+    """
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key = 'synced'").fetchone()
+    synced = row[0] if row else 0
+    for path in URL_FILES:
+        if Path(path).is_file() and Path(path).stat().st_mtime > synced:
+            import_url_file(conn, path, added_only=True)
+    mark_synced(conn)
+
+
+def ensure_imported(conn):
+    """
+    Import the text files into an empty registry, so that the registry picks
+    up where they left off, and otherwise those edited since, see
+    import_edited_files().
+    """
+    if conn.execute("SELECT COUNT(*) FROM repos").fetchone()[0] == 0:
+        import_text_files(conn)
+    else:
+        import_edited_files(conn)
+
+
+def write_url_file(path, urls):
+    tmp_path = Path(f"{path}.tmp")
+    with open(tmp_path, "w") as fp:
+        fp.writelines(f"{url}\n" for url in urls)
+    tmp_path.replace(path)
+
+
+def export_text_files(conn):
+    """
+    Write repositories.seen.txt, repositories.txt and blacklist.txt from the
+    registry, for the scripts and rules that read them. Edits made to them
+    since they were last written are imported first.
+    """
+    import_edited_files(conn)
+    write_url_file("repositories.seen.txt", [
+        url for url, in conn.execute(
+            "SELECT url FROM repos WHERE status = 'seen' AND NOT blacklisted "
+            "ORDER BY url")
+    ])
+    write_url_file("repositories.txt", [
+        url for url, in conn.execute(
+            "SELECT url FROM repos WHERE reached != 'seen' AND NOT blacklisted "
+            "ORDER BY url")
+    ])
+    write_url_file("blacklist.txt", [
+        url for url, in conn.execute(
+            "SELECT url FROM repos WHERE blacklisted ORDER BY url")
+    ])
+    mark_synced(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Manage the registry of repositories.")
+    parser.add_argument(
+        "command",
+        choices=["import", "export", "status"],
+        help="import the text files into the registry, export them from it, "
+        "or count the repositories by status")
+    parser.add_argument("--registry", type=Path, default=REGISTRY_PATH)
+    args = parser.parse_args()
+
+    with open_registry(args.registry) as conn:
+        if args.command == "import":
+            import_text_files(conn)
+        elif args.command == "export":
+            export_text_files(conn)
+        for status, blacklisted, count in conn.execute(
+                "SELECT status, blacklisted, COUNT(*) FROM repos "
+                "GROUP BY status, blacklisted ORDER BY status"):
+            blacklisted = " (blacklisted)" if blacklisted else ""
+            print(f"{status}{blacklisted}: {count}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
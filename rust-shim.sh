@@ -2,5 +2,20 @@
 
 echo "$@" >> ~/rust-commands.log
 
-rustup run nightly "$@"
-
+# BORROWCK_FLAGS only apply to the workspace's own crates, so that changing
+# them does not rebuild the dependencies, unlike RUSTFLAGS.
+if [ -n "$CARGO_PRIMARY_PACKAGE" ]; then
+    if [ -d "$PASS_TIMINGS_DIR" ]; then
+        # Keep the pass timings of each rustc run for benchmark.py
+        # --pass-timings, and pass its output on to cargo as usual.
+        crate_name=$(echo "$@" | sed -n 's/.*--crate-name \([^ ]*\).*/\1/p')
+        timings="$PASS_TIMINGS_DIR/$crate_name.$$"
+        rustup run nightly "$@" $BORROWCK_FLAGS -Ztime-passes 2> "$timings"
+        status=$?
+        cat "$timings" >&2
+        exit $status
+    fi
+    rustup run nightly "$@" $BORROWCK_FLAGS
+else
+    rustup run nightly "$@"
+fi
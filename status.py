@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 from pathlib import Path
 
+from nll_facts import corpus_index
+
 
 def file_len(fname):
     with open(fname) as f:
@@ -10,22 +12,21 @@ def file_len(fname):
         return i + 1
 
 
-def dir_size_bytes(d):
-    return sum(f.stat().st_size for f in d.rglob('*.facts'))
-
-
 if __name__ == '__main__':
     blacklist_len = file_len("blacklist.txt")
     whitelist_len = file_len("repositories.txt")
     fetched_facts_len = file_len("fetched-repos.txt")
 
-    fact_dirs = [d for d in Path("work").rglob("nll-facts") if d.is_dir()]
+    summaries = [
+        s for s in corpus_index(list(Path("work").iterdir())).values()
+        if s is not None
+    ]
 
     print(
-        f"Calculating the size of {len(fact_dirs)} accumulated fact directories..."
+        f"Calculating the size of {len(summaries)} accumulated fact directories..."
     )
 
-    fact_size_bytes = sum([dir_size_bytes(fact_dir) for fact_dir in fact_dirs])
+    fact_size_bytes = sum([s["bytes"] for s in summaries])
 
     print(
         f"Accumulated {fact_size_bytes / 1024 / 1024 / 1024:.1f} GB of raw facts."